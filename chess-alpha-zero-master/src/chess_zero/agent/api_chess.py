@@ -1,41 +1,391 @@
+import atexit
+import struct
+from bisect import bisect_left
+from collections import Counter, deque
+from logging import getLogger
 from multiprocessing import connection, Pipe
-from threading import Thread
+from threading import Event, Thread
+from time import time
 
 import numpy as np
 
 from chess_zero.config import Config
+from chess_zero.env.chess_env import codes_to_planes
+from chess_zero.lib.shm import SharedMemory, attach
+
+logger = getLogger(__name__)
+
+# upper edges (ms) of the queue delay histogram bins, the last bin takes everything above
+DELAY_BINS_MS = [0.5, 1, 2, 4, 8, 16, 32, 64]
+# a request on a pipe is its number of states (0 for a single state), what the slot holds for them
+# and whether the answer is the policy masked to the legal labels written with the states
+REQUEST = struct.Struct('<HBB')
+PLANES, BOARDS = 0, 1 # float32 input planes, or 90 uint8 codes of the canonical board (see chess_env)
+MAX_LEGAL = 128 # room for legal labels per state, a state with more gets the full policy
+DIGEST_SIZE = 64 # hex sha256 of the weights answering, see model_helper.fetch_digest
+
+
+class Slot:
+    """
+    the arrays of a pipe's shared memory slot, for up to max_states states: the inputs (planes or boards,
+    legal labels and their counts) and the outputs (full or masked policy, value), then the hex digest
+    of the weights that computed the outputs
+    """
+    def __init__(self, shm, max_states, n_labels, key=None):
+        self.shm = shm
+        self.key = key # which of ChessModelAPI.models answers the pipe
+        offset = 0
+        for name, shape, dtype in [('planes', (14, 10, 9), np.float32), ('policy', (n_labels,), np.float32),
+                                   ('value', (), np.float32), ('priors', (MAX_LEGAL,), np.float32),
+                                   ('labels', (MAX_LEGAL,), np.int16), ('counts', (), np.uint16),
+                                   ('boards', (10, 9), np.uint8)]:
+            ary = np.ndarray((max_states,) + shape, dtype=dtype, buffer=shm.buf, offset=offset)
+            setattr(self, name, ary)
+            offset += ary.nbytes
+        self.digest = np.ndarray((DIGEST_SIZE,), dtype=np.uint8, buffer=shm.buf, offset=offset)
+
+    @staticmethod
+    def size(max_states, n_labels):
+        per_state = (14 * 10 * 9 + n_labels + 1 + MAX_LEGAL) * 4 + MAX_LEGAL * 2 + 2 + 10 * 9
+        return max_states * per_state + DIGEST_SIZE
+
+
+def encode_digest(digest):
+    """:return: the hex digest as slot bytes, zeros for a model that has none"""
+    return np.frombuffer((digest or '').encode('ascii').ljust(DIGEST_SIZE, b'\0'), dtype=np.uint8)
+
+
+class SlotPipe:
+    """
+    the player end of a pipe to ChessModelAPI. Canonical boards (or planes) are written into a shared memory
+    slot of this pipe and only the request size goes through the pipe. The API writes policies and values
+    back into the slot and answers with an empty message. Picklable, the slot is attached again in the
+    receiving process.
+    """
+    def __init__(self, conn, shm_name, max_states, n_labels):
+        self.conn = conn
+        self.shm_name = shm_name
+        self.max_states = max_states
+        self.n_labels = n_labels
+        self.slot = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['slot'] = None # attached on first use
+        return state
+
+    def predict(self, planes):
+        """
+        :param planes: the planes of one state, or a (N, 14, 10, 9) batch of them
+        :return: policy and value, or (N, n_labels) policies and (N,) values for a batch. The arrays are views
+            of the slot, valid until the next call
+        """
+        return self.request(planes, planes.ndim == 4, PLANES)
+
+    @property
+    def digest(self):
+        """digest of the weights that answered the last request, None when they have none"""
+        digest = self.slot.digest.tobytes().rstrip(b'\0')
+        return digest.decode('ascii') if digest else None
+
+    def predict_boards(self, codes, labels=None):
+        """
+        like predict, for canonical board codes (see chess_env.canonical_codes) of one state or a (N, 10, 9)
+        batch. The planes are built on the inference side, for the whole batch at once
+        :param labels: label indices of the legal moves of the state (a list of them for a batch). The policy
+            is then only those labels' priors, renormalized and in their order (a list of them for a batch)
+        """
+        batch = codes.ndim == 3
+        if labels is None or max(len(x) for x in (labels if batch else [labels])) <= MAX_LEGAL:
+            return self.request(codes, batch, BOARDS, labels)
+        # too many moves for the slot, mask the full policy here
+        policy, value = self.request(codes, batch, BOARDS)
+        if not batch:
+            return masked(policy, labels), value
+        return [masked(p, x) for p, x in zip(policy, labels)], value
+
+    def request(self, data, batch, kind, labels=None):
+        if self.slot is None:
+            self.slot = Slot(attach(self.shm_name), self.max_states, self.n_labels)
+        slot = self.slot
+        n = len(data) if batch else 1
+        if n > self.max_states:
+            raise ValueError("%d states do not fit a slot of %d" % (n, self.max_states))
+        slot_data = slot.boards if kind == BOARDS else slot.planes
+        slot_data[:n] = data if batch else data[np.newaxis]
+        if labels is not None:
+            for i, x in enumerate(labels if batch else [labels]):
+                slot.labels[i, :len(x)] = x
+                slot.counts[i] = len(x)
+        self.conn.send_bytes(REQUEST.pack(n if batch else 0, kind, labels is not None))
+        self.conn.recv_bytes()
+
+        if labels is None:
+            return (slot.policy[:n], slot.value[:n]) if batch else (slot.policy[0], float(slot.value[0]))
+        if batch:
+            return [slot.priors[i, :len(x)] for i, x in enumerate(labels)], slot.value[:n]
+        return slot.priors[0, :len(labels)], float(slot.value[0])
+
+
+def masked(policy, labels):
+    prior = policy[labels]
+    total = np.sum(prior)
+    return prior / total if total > 0 else prior
+
+
+def unlink(shm):
+    try:
+        shm.unlink()
+    except FileNotFoundError: # already removed at exit
+        pass
 
 
 class ChessModelAPI:
+    """
+    runs the models for the pipes it handed out (see SlotPipe), batching their requests. A batch runs as soon as
+    predict_batch_size states wait, every pipe waits for an answer (nothing more can come), or the oldest
+    request waited predict_max_latency seconds. The states of a batch go to the model of their pipe's key,
+    one call per model. Calls are zero padded to the next of predict_batch_buckets so the backend only sees
+    those shapes. With no request pending the worker blocks on the pipes. New weights are switched in by
+    the worker between two batches (see swap).
+    """
     # noinspection PyUnusedLocal
-    def __init__(self, config: Config, agent_model):  # ChessModel
+    def __init__(self, config: Config, agent_model=None):  # ChessModel
         self.agent_model = agent_model
+        # model key -> ChessModel, the inference server (see worker.serve) binds its clients' models here
+        self.models = {None: agent_model} if agent_model is not None else {}
+        self.n_labels = config.n_labels
         self.pipes = []
+        self.slots = {} # our end of a pipe -> its Slot
+        mc = config.model
+        self.batch_size = mc.predict_batch_size
+        self.max_latency = mc.predict_max_latency
+        self.buckets = sorted(mc.predict_batch_buckets)
+        self.buffers = {} # bucket size -> input buffer
+        self.codes = np.empty((0, 10, 9), dtype=np.uint8)
+        # get_pipe wakes the worker through this pipe, so it waits on the new pipe too
+        self.wakeup_recv, self.wakeup_send = Pipe(duplex=False)
+        self.started = False
+        self.swaps = deque() # functions the worker runs before its next batch
+        self.batch_hist = Counter() # padded batch size -> batches
+        self.delay_hist = Counter() # queue delay bin -> requests
+        self.num_states = 0
+        self.num_padded = 0
+        self.report_interval = 60
+        self.last_report = time()
+        atexit.register(self.unlink_slots)
 
     def start(self):
         prediction_worker = Thread(target=self.predict_batch_worker, name="prediction_worker")
         prediction_worker.daemon = True
         prediction_worker.start()
+        self.started = True
 
-    def get_pipe(self):
+    def get_pipe(self, max_states=1):
+        """
+        :param max_states: the most states the pipe sends in one request
+        """
         me, you = Pipe()
-        self.pipes.append(me)
-        return you
+        return SlotPipe(you, self.add_pipe(me, max_states), max_states, self.n_labels)
+
+    def add_pipe(self, conn, max_states=1, key=None):
+        """
+        serve requests coming in on conn, which can be any connection (a socket of the inference server)
+        :param key: key of the model in models that answers them
+        :return: name of the shared memory slot of the pipe
+        """
+        shm = SharedMemory(create=True, size=Slot.size(max_states, self.n_labels))
+        self.slots[conn] = Slot(shm, max_states, self.n_labels, key)
+        self.pipes.append(conn)
+        self.wakeup_send.send_bytes(b'')
+        return shm.name
+
+    def close_pipe(self, pipe):
+        pipe.close()
+        self.pipes.remove(pipe)
+        shm = self.slots.pop(pipe).shm
+        shm.close()
+        unlink(shm)
+
+    def unlink_slots(self):
+        """remove the names of the slots at exit, the mappings stay valid for whoever still uses them"""
+        for slot in list(self.slots.values()):
+            unlink(slot.shm)
+
+    def swap(self, apply):
+        """
+        call apply, which switches the weights of a model, in the worker between two batches and wait for it
+        """
+        if not self.started:
+            apply()
+            return
+        done = Event()
+        error = []
+
+        def run():
+            try:
+                apply()
+            except Exception as e:
+                error.append(e)
+            done.set()
+        self.swaps.append(run)
+        self.wakeup_send.send_bytes(b'')
+        done.wait()
+        if error:
+            raise error[0]
 
     def predict_batch_worker(self):
+        pending = [] # (pipe, number of states or 0 for a single state, PLANES or BOARDS, masked, arrival time)
+        num_pending = 0
         while True:
-            ready = connection.wait(self.pipes,timeout=0.001)
-            if not ready:
-                continue
-            data, result_pipes = [], []
-            for pipe in ready:
-                while pipe.poll():
-                    try:
-                        data.append(pipe.recv())
-                        result_pipes.append(pipe)
-                    except EOFError as e:
-                        pipe.close()
-            data = np.asarray(data, dtype=np.float32)
-            policy_ary, value_ary = self.agent_model.model.predict_on_batch(data)
-            for pipe, p, v in zip(result_pipes, policy_ary, value_ary):
-                pipe.send((p, float(v)))
+            timeout = None
+            if pending:
+                timeout = max(0, pending[0][4] + self.max_latency - time())
+            for pipe in connection.wait(self.pipes + [self.wakeup_recv], timeout):
+                if pipe is self.wakeup_recv:
+                    pipe.recv_bytes()
+                    continue
+                try:
+                    size, kind, masked = REQUEST.unpack(pipe.recv_bytes())
+                except EOFError:
+                    self.close_pipe(pipe)
+                    continue
+                pending.append((pipe, size, kind, masked, time()))
+                num_pending += max(size, 1)
+            while self.swaps:
+                self.swaps.popleft()()
+
+            if pending and (num_pending >= self.batch_size or len(pending) >= len(self.pipes) or
+                            time() >= pending[0][4] + self.max_latency):
+                self.run_batch(pending, num_pending)
+                pending = []
+                num_pending = 0
+
+            if time() - self.last_report >= self.report_interval:
+                self.report()
+
+    def run_batch(self, requests, num_states):
+        now = time()
+        for _, _, _, _, arrival in requests:
+            self.delay_hist[bisect_left(DELAY_BINS_MS, (now - arrival) * 1000)] += 1
+
+        groups = {} # model key -> requests
+        for request in requests:
+            groups.setdefault(self.slots[request[0]].key, []).append(request)
+        if len(groups) == 1:
+            self.run_model(self.models.get(next(iter(groups))), requests, num_states)
+            return
+        for key, group in groups.items():
+            self.run_model(self.models.get(key), group, sum(max(size, 1) for _, size, _, _, _ in group))
+
+    def run_model(self, agent_model, requests, num_states):
+        if agent_model is None or agent_model.model is None: # the model of the pipes went away
+            for pipe, _, _, _, _ in requests:
+                self.close_pipe(pipe)
+            return
+
+        # boards are gathered from the slots and one hot encoded for the whole batch in one call,
+        # requests sent as planes are copied over their (empty) rows afterwards
+        data = self.batch_buffer(num_states)
+        codes = self.codes_buffer(num_states)
+        plane_rows = []
+        k = 0
+        for pipe, size, kind, _, _ in requests:
+            n = max(size, 1)
+            if kind == BOARDS:
+                codes[k:k + n] = self.slots[pipe].boards[:n]
+            else:
+                codes[k:k + n] = 0
+                plane_rows.append((k, n, pipe))
+            k += n
+        codes_to_planes(codes, data[:num_states])
+        for k, n, pipe in plane_rows:
+            data[k:k + n] = self.slots[pipe].planes[:n]
+
+        # batches larger than the largest bucket run in chunks of it
+        policy_ary, value_ary = [], []
+        for i in range(0, len(data), self.buckets[-1]):
+            chunk = data[i:i + self.buckets[-1]]
+            self.batch_hist[len(chunk)] += 1
+            policy, value = agent_model.predict_on_batch(chunk)
+            policy_ary.append(policy)
+            value_ary.append(value)
+        policy_ary = np.concatenate(policy_ary) if len(policy_ary) > 1 else policy_ary[0]
+        value_ary = np.concatenate(value_ary) if len(value_ary) > 1 else value_ary[0]
+        self.num_states += num_states
+        self.num_padded += len(data) - num_states
+
+        priors = None
+        if any(masked for _, _, _, masked, _ in requests):
+            priors = self.masked_priors(requests, num_states, policy_ary)
+        digest = encode_digest(agent_model.digest) # swaps run between batches, so these are the weights of this one
+        k = 0
+        for pipe, size, _, masked, _ in requests:
+            n = max(size, 1)
+            slot = self.slots[pipe]
+            slot.digest[:] = digest
+            if masked:
+                slot.priors[:n] = priors[k:k + n]
+            else:
+                slot.policy[:n] = policy_ary[k:k + n]
+            slot.value[:n] = value_ary[k:k + n, 0]
+            pipe.send_bytes(b'')
+            k += n
+
+    def masked_priors(self, requests, num_states, policy_ary):
+        """
+        :return: (num_states, MAX_LEGAL) priors of the legal labels sent with the masked requests,
+            renormalized and zero past each state's count. Unmasked rows are left zero
+        """
+        labels = np.zeros((num_states, MAX_LEGAL), dtype=np.int16)
+        counts = np.zeros(num_states, dtype=np.uint16)
+        k = 0
+        for pipe, size, _, masked, _ in requests:
+            n = max(size, 1)
+            if masked:
+                slot = self.slots[pipe]
+                labels[k:k + n] = slot.labels[:n]
+                counts[k:k + n] = slot.counts[:n]
+            k += n
+        priors = policy_ary[np.arange(num_states)[:, np.newaxis], labels]
+        priors[np.arange(MAX_LEGAL) >= counts[:, np.newaxis]] = 0
+        total = np.sum(priors, axis=1, keepdims=True)
+        np.divide(priors, total, out=priors, where=total > 0)
+        return priors
+
+    def batch_buffer(self, num_states):
+        """
+        :return: zero padded float32 input buffer with room for num_states, sized to a bucket
+            (or a multiple of the largest bucket)
+        """
+        i = bisect_left(self.buckets, num_states)
+        if i < len(self.buckets):
+            size = self.buckets[i]
+        else:
+            size = -(-num_states // self.buckets[-1]) * self.buckets[-1]
+        buf = self.buffers.get(size)
+        if buf is None:
+            buf = self.buffers[size] = np.zeros((size, 14, 10, 9), dtype=np.float32)
+        else:
+            buf[num_states:] = 0
+        return buf
+
+    def codes_buffer(self, num_states):
+        if len(self.codes) < num_states:
+            self.codes = np.empty((num_states, 10, 9), dtype=np.uint8)
+        return self.codes[:num_states]
+
+    def report(self):
+        self.last_report = time()
+        batches = sum(self.batch_hist.values())
+        if not batches:
+            return
+        delay_names = ['<%gms' % x for x in DELAY_BINS_MS] + ['>=%gms' % DELAY_BINS_MS[-1]]
+        logger.debug("predict: %d batches, %.1f states per batch, %.1f%% padding, batch sizes {%s}, queue delay {%s}" % (
+            batches, self.num_states / batches, 100 * self.num_padded / max(self.num_states + self.num_padded, 1),
+            ", ".join("%d: %d" % kv for kv in sorted(self.batch_hist.items())),
+            ", ".join("%s: %d" % (delay_names[i], n) for i, n in sorted(self.delay_hist.items()))))
+        self.batch_hist.clear()
+        self.delay_hist.clear()
+        self.num_states = 0
+        self.num_padded = 0
@@ -0,0 +1,368 @@
+"""
+inference backends for ChessModelAPI, chosen by ModelConfig.backend. A backend has the predict_on_batch of a
+keras model: (N, 14, 10, 9) input planes in, (N, n_labels) policies and (N, 1) values out.
+
+keras  - the keras model itself
+frozen - the keras graph with its variables frozen to constants, run in a session of its own
+numpy  - a numpy forward pass of the residual tower
+onnx   - the same network as an onnx graph run by onnxruntime (optional dependencies onnx and onnxruntime)
+
+numpy and onnx read the weights straight from the keras weight file (h5py) and fold every batch
+normalization into the convolution before it. ModelConfig.backend_dtype fp16 or int8 quantizes their
+weights (int8 per output channel); numpy computes in float32 with them, onnxruntime may run int8 convolutions.
+export_weights and export_onnx write them to a file next to the weight file (cmd export, see exported_path).
+With ModelConfig.backend_exported the backends load that file instead, and new_model gives an ExportedChessModel
+(see agent/exported_chess.py), which needs neither keras nor the weight file. bench suite backends compares them.
+"""
+import os
+import re
+from logging import getLogger
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+BACKENDS = ['keras', 'frozen', 'numpy', 'onnx']
+DTYPES = ['fp32', 'fp16', 'int8']
+BN_EPSILON = 1e-3 # keras BatchNormalization default
+
+
+def create_backend(config, chess_model, weight_path):
+    """
+    :param ChessModel chess_model: with its keras model loaded from weight_path
+    :return: the backend of config.model.backend, or None for keras
+    """
+    mc = config.model
+    if mc.backend == 'keras':
+        return None
+    if mc.backend == 'frozen':
+        return FrozenGraphBackend(chess_model.model)
+    if mc.backend_exported:
+        return load_exported_backend(config, weight_path)
+    weights = fold_weights(read_keras_weights(weight_path))
+    if mc.backend == 'numpy':
+        return NumpyBackend(quantized(weights, mc.backend_dtype))
+    if mc.backend == 'onnx':
+        return OnnxBackend(onnx_model(weights, mc.backend_dtype).SerializeToString())
+    raise RuntimeError('unknown backend: %s (choose from %s)' % (mc.backend, ', '.join(BACKENDS)))
+
+
+EXPORT_FORMATS = {'numpy': 'npz', 'onnx': 'onnx'} # backend -> format of the file it loads with backend_exported
+
+
+def exported_path(weight_path, dtype, fmt):
+    """:return: the file cmd export writes the weights of weight_path to, as dtype in format fmt"""
+    return "%s.%s.%s" % (os.path.splitext(weight_path)[0], dtype, fmt)
+
+
+def backend_export_path(config, weight_path):
+    """:return: the exported file of weight_path that the backend of config.model loads"""
+    mc = config.model
+    if mc.backend not in EXPORT_FORMATS:
+        raise RuntimeError('backend_exported needs backend numpy or onnx, not %s' % mc.backend)
+    return exported_path(weight_path, mc.backend_dtype, EXPORT_FORMATS[mc.backend])
+
+
+def load_exported_backend(config, weight_path):
+    """
+    :return: the numpy or onnx backend of config.model with the weights cmd export wrote for weight_path
+    """
+    path = backend_export_path(config, weight_path)
+    if config.model.backend == 'numpy':
+        return NumpyBackend(load_exported_weights(path))
+    return OnnxBackend(path)
+
+
+def read_keras_weights(weight_path):
+    """
+    :return: {layer name: {weight name (kernel, gamma, ...): array}} from a file written by save_weights
+    """
+    import h5py
+    layers = {}
+    with h5py.File(weight_path, 'r') as f:
+        if 'model_weights' in f: # written by model.save
+            f = f['model_weights']
+        for layer in f.attrs['layer_names']:
+            layer = layer.decode() if isinstance(layer, bytes) else layer
+            g = f[layer]
+            weights = {}
+            for name in g.attrs['weight_names']:
+                name = name.decode() if isinstance(name, bytes) else name
+                weights[name.split('/')[-1].split(':')[0]] = np.asarray(g[name], dtype=np.float32)
+            if weights:
+                layers[layer] = weights
+    return layers
+
+
+def fold_weights(layers):
+    """
+    :param layers: see read_keras_weights, of a model made by ChessModel.build
+    :return: {name: float32 array} of the network with each batch normalization folded into its convolution.
+        Convolutions are (kh, kw, in, out) kernels with a bias, dense layers (in, out) with a bias
+    """
+    def layer(prefix):
+        names = [name for name in layers if name == prefix or name.startswith(prefix + '-')]
+        if len(names) != 1:
+            raise RuntimeError('no layer %s in the weights' % prefix)
+        return layers[names[0]]
+
+    def conv_bn(conv, bn):
+        w = layer(conv)['kernel']
+        bn = layer(bn)
+        scale = bn['gamma'] / np.sqrt(bn['moving_variance'] + BN_EPSILON)
+        return w * scale, bn['beta'] - bn['moving_mean'] * scale
+
+    weights = {}
+    weights['input.w'], weights['input.b'] = conv_bn('input_conv', 'input_batchnorm')
+    num_res = len([name for name in layers if re.match(r'res\d+_conv1', name)])
+    for i in range(1, num_res + 1):
+        weights['res%d.w1' % i], weights['res%d.b1' % i] = conv_bn('res%d_conv1' % i, 'res%d_batchnorm1' % i)
+        weights['res%d.w2' % i], weights['res%d.b2' % i] = conv_bn('res%d_conv2' % i, 'res%d_batchnorm2' % i)
+    weights['policy_conv.w'], weights['policy_conv.b'] = conv_bn('policy_conv', 'policy_batchnorm')
+    weights['value_conv.w'], weights['value_conv.b'] = conv_bn('value_conv', 'value_batchnorm')
+    for name in ('policy_out', 'value_dense', 'value_out'):
+        weights[name + '.w'], weights[name + '.b'] = layer(name)['kernel'], layer(name)['bias']
+    return {name: np.ascontiguousarray(w, dtype=np.float32) for name, w in weights.items()}
+
+
+def random_weights(config, seed=0):
+    """:return: folded weights of the shape of config.model, for timing the backends without a trained model"""
+    mc = config.model
+    rnd = np.random.RandomState(seed)
+
+    def kernel(*shape):
+        return (rnd.randn(*shape) * np.sqrt(2 / np.prod(shape[:-1]))).astype(np.float32)
+
+    def bias(n):
+        return (rnd.randn(n) * 0.1).astype(np.float32)
+
+    f = mc.cnn_filter_num
+    weights = {'input.w': kernel(mc.cnn_first_filter_size, mc.cnn_first_filter_size, 14, f), 'input.b': bias(f)}
+    for i in range(1, mc.res_layer_num + 1):
+        for j in (1, 2):
+            weights['res%d.w%d' % (i, j)] = kernel(mc.cnn_filter_size, mc.cnn_filter_size, f, f) / np.sqrt(2)
+            weights['res%d.b%d' % (i, j)] = bias(f)
+    weights.update({
+        'policy_conv.w': kernel(1, 1, f, 2), 'policy_conv.b': bias(2),
+        'policy_out.w': kernel(2 * 90, config.n_labels), 'policy_out.b': bias(config.n_labels),
+        'value_conv.w': kernel(1, 1, f, 4), 'value_conv.b': bias(4),
+        'value_dense.w': kernel(4 * 90, mc.value_fc_size), 'value_dense.b': bias(mc.value_fc_size),
+        'value_out.w': kernel(mc.value_fc_size, 1) * 0.1, 'value_out.b': bias(1)})
+    return {name: w.astype(np.float32) for name, w in weights.items()}
+
+
+def quantize(weights, dtype):
+    """
+    :return: the weights to store for dtype: kernels as float16, or as int8 with a float32 scale per output
+        channel (name + '.scale'). Biases stay float32
+    """
+    if dtype not in DTYPES:
+        raise RuntimeError('unknown dtype: %s (choose from %s)' % (dtype, ', '.join(DTYPES)))
+    stored = {}
+    for name, w in weights.items():
+        if dtype == 'fp32' or name.split('.')[-1].startswith('b'):
+            stored[name] = w
+        elif dtype == 'fp16':
+            stored[name] = w.astype(np.float16)
+        else:
+            stored[name], stored[name + '.scale'] = quantize_int8(w)
+    return stored
+
+
+def quantize_int8(w, axis=-1):
+    """
+    :return: symmetric int8 weights and the float32 scale of each channel along axis (the output channels)
+    """
+    moved = np.moveaxis(w, axis, -1)
+    scale = np.max(np.abs(moved.reshape(-1, moved.shape[-1])), axis=0) / 127
+    scale[scale == 0] = 1
+    q = np.clip(np.round(moved / scale), -127, 127).astype(np.int8)
+    return np.ascontiguousarray(np.moveaxis(q, -1, axis)), scale.astype(np.float32)
+
+
+def dequantize(stored):
+    """:return: float32 weights from what quantize stored"""
+    weights = {}
+    for name, w in stored.items():
+        if name.endswith('.scale'):
+            continue
+        w = w.astype(np.float32)
+        if name + '.scale' in stored:
+            w *= stored[name + '.scale']
+        weights[name] = w
+    return weights
+
+
+def quantized(weights, dtype):
+    """:return: the weights as the backends see them after storing them as dtype"""
+    return weights if dtype == 'fp32' else dequantize(quantize(weights, dtype))
+
+
+def export_weights(weight_path, out_path, dtype='fp16'):
+    """write the folded weights of a keras weight file as an npz of dtype, read back by load_exported_weights"""
+    np.savez(out_path, **quantize(fold_weights(read_keras_weights(weight_path)), dtype))
+
+
+def export_onnx(weight_path, out_path, dtype='fp16'):
+    """write the network of a keras weight file as an onnx model with weights of dtype"""
+    with open(out_path, 'wb') as f:
+        f.write(onnx_model(fold_weights(read_keras_weights(weight_path)), dtype).SerializeToString())
+
+
+def load_exported_weights(path):
+    """:return: float32 weights from a file written by export_weights"""
+    with np.load(path) as f:
+        return dequantize({name: f[name] for name in f.files})
+
+
+class NumpyBackend:
+    """the network in numpy: convolutions as one matrix product over im2col columns, activations in NHWC"""
+    def __init__(self, weights):
+        self.weights = weights
+        self.num_res = len([name for name in weights if name.endswith('.w1')])
+
+    def predict_on_batch(self, x):
+        w = self.weights
+        x = np.ascontiguousarray(np.asarray(x, dtype=np.float32).transpose(0, 2, 3, 1))
+        x = relu(conv(x, w['input.w'], w['input.b']))
+        for i in range(1, self.num_res + 1):
+            y = relu(conv(x, w['res%d.w1' % i], w['res%d.b1' % i]))
+            y = conv(y, w['res%d.w2' % i], w['res%d.b2' % i])
+            x = relu(y + x)
+
+        policy = flatten(relu(conv(x, w['policy_conv.w'], w['policy_conv.b'])))
+        policy = softmax(policy @ w['policy_out.w'] + w['policy_out.b'])
+        value = flatten(relu(conv(x, w['value_conv.w'], w['value_conv.b'])))
+        value = relu(value @ w['value_dense.w'] + w['value_dense.b'])
+        value = np.tanh(value @ w['value_out.w'] + w['value_out.b'])
+        return policy, value
+
+
+def conv(x, w, b):
+    """'same' convolution of NHWC x with a (kh, kw, in, out) kernel"""
+    kh, kw, c, f = w.shape
+    n, h, wd, _ = x.shape
+    if kh == kw == 1:
+        return (x.reshape(-1, c) @ w.reshape(c, f) + b).reshape(n, h, wd, f)
+    padded = np.zeros((n, h + kh - 1, wd + kw - 1, c), dtype=np.float32)
+    padded[:, kh // 2:kh // 2 + h, kw // 2:kw // 2 + wd] = x
+    cols = np.empty((n, h, wd, kh, kw, c), dtype=np.float32)
+    for i in range(kh):
+        for j in range(kw):
+            cols[:, :, :, i, j] = padded[:, i:i + h, j:j + wd]
+    return (cols.reshape(n * h * wd, -1) @ w.reshape(-1, f) + b).reshape(n, h, wd, f)
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def flatten(x):
+    """flatten NHWC in the channels first order of the keras Flatten layers"""
+    return x.transpose(0, 3, 1, 2).reshape(len(x), -1)
+
+
+def softmax(x):
+    x = np.exp(x - np.max(x, axis=1, keepdims=True))
+    return x / np.sum(x, axis=1, keepdims=True)
+
+
+class OnnxBackend:
+    """the network as an onnx graph (see onnx_model), run by onnxruntime on the CPU"""
+    def __init__(self, model):
+        """
+        :param model: the serialized onnx model, or the path of a file written by export_onnx
+        """
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(model, providers=['CPUExecutionProvider'])
+
+    def predict_on_batch(self, x):
+        policy, value = self.session.run(['policy', 'value'], {'planes': np.asarray(x, dtype=np.float32)})
+        return policy, value
+
+
+def onnx_model(weights, dtype='fp32'):
+    """
+    :return: onnx ModelProto of the folded network, with a dynamic batch size. With dtype fp16 or int8 the
+        kernels are stored as such and turned into float32 by Cast or DequantizeLinear nodes
+    """
+    from onnx import helper, numpy_helper, TensorProto
+    if dtype not in DTYPES:
+        raise RuntimeError('unknown dtype: %s (choose from %s)' % (dtype, ', '.join(DTYPES)))
+    nodes = []
+    initializers = []
+
+    def const(name, ary):
+        initializers.append(numpy_helper.from_array(ary, name))
+        return name
+
+    def node(op, inputs, output, **attrs):
+        nodes.append(helper.make_node(op, inputs, [output], **attrs))
+        return output
+
+    def kernel(name, w, axis):
+        """:param axis: of the output channels"""
+        if dtype == 'fp16':
+            return node('Cast', [const(name, w.astype(np.float16))], name + '.float', to=TensorProto.FLOAT)
+        if dtype == 'int8':
+            q, scale = quantize_int8(w, axis)
+            return node('DequantizeLinear', [const(name, q), const(name + '.scale', scale),
+                                             const(name + '.zero', np.zeros(len(scale), dtype=np.int8))],
+                        name + '.float', axis=axis)
+        return const(name, w)
+
+    def conv_node(x, name, wkey, bkey):
+        w = weights[wkey]
+        kh, kw = w.shape[:2]
+        w = kernel(wkey, np.ascontiguousarray(w.transpose(3, 2, 0, 1)), 0)
+        return node('Conv', [x, w, const(bkey, weights[bkey])], name, pads=[kh // 2, kw // 2, kh // 2, kw // 2])
+
+    def dense_node(x, name, key):
+        return node('Gemm', [x, kernel(key + '.w', weights[key + '.w'], 1), const(key + '.b', weights[key + '.b'])],
+                    name)
+
+    num_res = len([name for name in weights if name.endswith('.w1')])
+    x = node('Relu', [conv_node('planes', 'input_conv', 'input.w', 'input.b')], 'input_relu')
+    for i in range(1, num_res + 1):
+        y = node('Relu', [conv_node(x, 'res%d_conv1' % i, 'res%d.w1' % i, 'res%d.b1' % i)], 'res%d_relu1' % i)
+        y = conv_node(y, 'res%d_conv2' % i, 'res%d.w2' % i, 'res%d.b2' % i)
+        x = node('Relu', [node('Add', [x, y], 'res%d_add' % i)], 'res%d_relu2' % i)
+
+    p = node('Relu', [conv_node(x, 'policy_conv', 'policy_conv.w', 'policy_conv.b')], 'policy_relu')
+    p = dense_node(node('Flatten', [p], 'policy_flatten', axis=1), 'policy_logits', 'policy_out')
+    node('Softmax', [p], 'policy', axis=1)
+    v = node('Relu', [conv_node(x, 'value_conv', 'value_conv.w', 'value_conv.b')], 'value_relu')
+    v = dense_node(node('Flatten', [v], 'value_flatten', axis=1), 'value_dense', 'value_dense')
+    v = dense_node(node('Relu', [v], 'value_dense_relu'), 'value_logit', 'value_out')
+    node('Tanh', [v], 'value')
+
+    graph = helper.make_graph(
+        nodes, 'chess_model', [helper.make_tensor_value_info('planes', TensorProto.FLOAT, ['N', 14, 10, 9])],
+        [helper.make_tensor_value_info('policy', TensorProto.FLOAT, ['N', weights['policy_out.w'].shape[1]]),
+         helper.make_tensor_value_info('value', TensorProto.FLOAT, ['N', 1])], initializers)
+    return helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], ir_version=7)
+
+
+class FrozenGraphBackend:
+    """the graph of a loaded keras model with its variables turned into constants, run in a session of its own"""
+    def __init__(self, model):
+        import tensorflow as tf
+        from keras import backend as K
+        session = K.get_session()
+        outputs = [t.op.name for t in model.outputs]
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), outputs)
+        graph_def = tf.graph_util.remove_training_nodes(graph_def)
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self.session = tf.Session(graph=graph)
+        self.input = graph.get_tensor_by_name(model.input.name)
+        self.outputs = [graph.get_tensor_by_name(t.name) for t in model.outputs]
+        self.feed = {}
+        learning_phase = K.learning_phase()
+        if not isinstance(learning_phase, int) and learning_phase.op.name in [n.name for n in graph_def.node]:
+            self.feed[graph.get_tensor_by_name(learning_phase.name)] = False
+
+    def predict_on_batch(self, x):
+        self.feed[self.input] = x
+        return self.session.run(self.outputs, self.feed)
@@ -0,0 +1,64 @@
+import os
+from logging import getLogger
+
+from chess_zero.agent.api_chess import ChessModelAPI
+from chess_zero.agent.backend_chess import backend_export_path, load_exported_backend
+from chess_zero.config import Config
+from chess_zero.lib.model_helper import fetch_digest
+
+logger = getLogger(__name__)
+
+
+class ExportedChessModel:
+    """
+    stands in for ChessModel with ModelConfig.backend_exported: the numpy or onnx backend runs the file cmd export
+    wrote next to a weight file (see backend_chess.exported_path), so neither keras nor the weight file is needed.
+    The digest is that of the exported file. It only runs the network, build and save need a ChessModel.
+    Never imports tensorflow.
+    """
+    def __init__(self, config: Config):
+        if config.model.distributed:
+            raise RuntimeError('backend_exported does not work in distributed mode, the store holds keras weights')
+        self.config = config
+        self.model = None # the backend
+        self.digest = None
+        self.api = None # the ChessModelAPI running the model
+
+    def predict_on_batch(self, x):
+        return self.model.predict_on_batch(x)
+
+    def get_pipes(self, num=1, max_states=1):
+        """
+        :param max_states: the most states a pipe sends in one request
+        """
+        if self.api is None:
+            self.api = ChessModelAPI(self.config, self)
+            self.api.start()
+        return [self.api.get_pipe(max_states) for _ in range(num)]
+
+    def fetch_digest(self, weight_path):
+        return fetch_digest(backend_export_path(self.config, weight_path))
+
+    def build(self):
+        raise RuntimeError('an exported model cannot be built, run cmd export on a model saved by ChessModel')
+
+    def load(self, config_path, weight_path):
+        path = backend_export_path(self.config, weight_path)
+        if not os.path.exists(path):
+            logger.debug("exported model does not exist at %s" % path)
+            return False
+        backend = load_exported_backend(self.config, weight_path)
+        digest = fetch_digest(path)
+
+        def apply():
+            self.model = backend
+            self.digest = digest
+        if self.api is None:
+            apply()
+        else:
+            self.api.swap(apply) # between two batches, like ChessModel.swap_weights
+        logger.debug("loaded exported model %s digest = %s" % (path, self.digest))
+        return True
+
+    def save(self, config_path, weight_path):
+        raise RuntimeError('an exported model cannot be saved')
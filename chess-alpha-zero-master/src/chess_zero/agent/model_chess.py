@@ -1,46 +1,65 @@
-import ftplib
-import hashlib
 import json
 import os
 from logging import getLogger
-
-
-import tensorflow as tf
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-config.gpu_options.visible_device_list='0'
-session = tf.Session(config=config)
-
-from keras.engine.topology import Input
-from keras.engine.training import Model
-from keras.layers.convolutional import Conv2D
-from keras.layers.core import Activation, Dense, Flatten
-from keras.layers.merge import Add
-from keras.layers.normalization import BatchNormalization
-from keras.regularizers import l2
+from time import time
 
 from chess_zero.agent.api_chess import ChessModelAPI
+from chess_zero.agent.backend_chess import create_backend, read_keras_weights
 from chess_zero.config import Config
+from chess_zero.lib.model_helper import fetch_digest, write_manifest
+from chess_zero.lib.model_store import STORE_ERRORS, open_store
 
 # noinspection PyPep8Naming
 
 logger = getLogger(__name__)
 
+_session = None
+
+
+def init_session():
+    """
+    create the tensorflow session on first use instead of at import, so commands that never run the network
+    (and uci until it does) start without loading tensorflow
+    """
+    global _session
+    if _session is None:
+        import tensorflow as tf
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
+        config.gpu_options.visible_device_list = '0'
+        _session = tf.Session(config=config)
+    return _session
+
 
 class ChessModel:
     def __init__(self, config: Config):
+        init_session()
         self.config = config
-        self.model = None  # type: Model
+        self.model = None  # type: keras.engine.training.Model
+        self.model_config = None # json of the model's architecture, a load with the same one only swaps weights
         self.digest = None
-        self.api = None
+        self.api = None # the ChessModelAPI running the model
+        self.backend = None # runs the predictions instead of model, see ModelConfig.backend
+
+    def predict_on_batch(self, x):
+        return (self.backend or self.model).predict_on_batch(x)
 
-    def get_pipes(self, num = 1):
+    def get_pipes(self, num = 1, max_states=1):
+        """
+        :param max_states: the most states a pipe sends in one request
+        """
         if self.api is None:
             self.api = ChessModelAPI(self.config, self)
             self.api.start()
-        return [self.api.get_pipe() for _ in range(num)]
+        return [self.api.get_pipe(max_states) for _ in range(num)]
 
     def build(self):
+        from keras.engine.topology import Input
+        from keras.engine.training import Model
+        from keras.layers.convolutional import Conv2D
+        from keras.layers.core import Activation, Dense, Flatten
+        from keras.layers.normalization import BatchNormalization
+        from keras.regularizers import l2
         mc = self.config.model
         # in_x = x = Input((18, 8, 8))
         in_x = x = Input((14,10,9)) # change to CC
@@ -76,8 +95,14 @@ class ChessModel:
         value_out = Dense(1, kernel_regularizer=l2(mc.l2_reg), activation="tanh", name="value_out")(x)
 
         self.model = Model(in_x, [policy_out, value_out], name="chess_model")
+        self.model_config = json.loads(json.dumps(self.model.get_config()))
 
     def _build_residual_block(self, x, index):
+        from keras.layers.convolutional import Conv2D
+        from keras.layers.core import Activation
+        from keras.layers.merge import Add
+        from keras.layers.normalization import BatchNormalization
+        from keras.regularizers import l2
         mc = self.config.model
         in_x = x
         res_name = "res"+str(index)
@@ -94,42 +119,75 @@ class ChessModel:
         x = Activation("relu", name=res_name+"_relu2")(x)
         return x
 
-    @staticmethod
-    def fetch_digest(weight_path):
-        if os.path.exists(weight_path):
-            m = hashlib.sha256()
-            with open(weight_path, "rb") as f:
-                m.update(f.read())
-            return m.hexdigest()
+    fetch_digest = staticmethod(fetch_digest)
 
     def load(self, config_path, weight_path):
         mc = self.config.model
         resources = self.config.resource
         if mc.distributed and config_path == resources.model_best_config_path:
             try:
-                logger.debug("loading model from server")
-                ftp_connection = ftplib.FTP(resources.model_best_distributed_ftp_server,
-                                            resources.model_best_distributed_ftp_user,
-                                            resources.model_best_distributed_ftp_password)
-                ftp_connection.cwd(resources.model_best_distributed_ftp_remote_path)
-                ftp_connection.retrbinary("RETR model_best_config.json", open(config_path, 'wb').write)
-                ftp_connection.retrbinary("RETR model_best_weight.h5", open(weight_path, 'wb').write)
-                ftp_connection.quit()
-            except:
-                pass
+                logger.debug("pulling model from the model store")
+                with open_store(self.config) as store:
+                    store.pull(config_path, weight_path)
+            except STORE_ERRORS as e:
+                logger.warning("could not pull the best model, loading the local one: %s" % e)
         if os.path.exists(config_path) and os.path.exists(weight_path):
             logger.debug("loading model from %s" % (config_path))
             with open(config_path, "rt") as f:
-                self.model = Model.from_config(json.load(f))
-            self.model.load_weights(weight_path)
-            self.model._make_predict_function()
-            self.digest = self.fetch_digest(weight_path)
+                model_config = json.load(f)
+            digest = self.fetch_digest(weight_path)
+            if self.model is not None and model_config == self.model_config:
+                self.swap_weights(weight_path, digest)
+            else:
+                from keras.engine.training import Model
+                self.model = Model.from_config(model_config)
+                self.model_config = model_config
+                self.model.load_weights(weight_path)
+                self.model._make_predict_function()
+                self.backend = create_backend(self.config, self, weight_path)
+                self.digest = digest
             logger.debug("loaded model digest = %s" % (self.digest))
             return True
         else:
             logger.debug("model files does not exist at %s and %s" % (config_path, weight_path))
             return False
 
+    def swap_weights(self, weight_path, digest):
+        """
+        load weights into the graph already built instead of building a new one. Whatever runs the predictions
+        is switched to them by the prediction thread of the API, between two batches, so the pipes stay
+        open and search goes on while the weights are read. The digest changes along with them, the API
+        answers every batch with the digest of the weights that ran it (see SlotPipe.digest)
+        """
+        from keras import backend as K
+        start = time()
+        layers = read_keras_weights(weight_path)
+        values = []
+        for layer in self.model.layers:
+            if layer.weights:
+                if layer.name not in layers:
+                    raise RuntimeError("%s has no weights for layer %s" % (weight_path, layer.name))
+                values += zip(layer.weights, layers[layer.name].values())
+
+        if self.backend is None: # keras predicts, its variables must not change under a batch
+            def apply():
+                K.batch_set_value(values)
+                self.digest = digest
+        else: # the keras model is only saved from, the backend is built from it and switched
+            K.batch_set_value(values)
+            backend = create_backend(self.config, self, weight_path)
+
+            def apply():
+                self.backend = backend
+                self.digest = digest
+        staged = time()
+        if self.api is None:
+            apply()
+        else:
+            self.api.swap(apply)
+        logger.info("swapped in the weights of %s in %.1fms, %.1fms of it waiting for the running batch" % (
+            weight_path, (time() - start) * 1000, (time() - staged) * 1000))
+
     def save(self, config_path, weight_path):
         logger.debug("saving model to %s" % (config_path))
         print('debug-3')
@@ -139,8 +197,9 @@ class ChessModel:
             print('debug-1')
             self.model.save_weights(weight_path)
             print('debug-0')
-        self.digest = self.fetch_digest(weight_path)
-        logger.debug("saved model digest %s" % (self.digest))
+        manifest = write_manifest(weight_path)
+        self.digest = manifest['digest']
+        logger.debug("saved model digest %s generation %d" % (self.digest, manifest['generation']))
 
         print('debug')
 
@@ -149,20 +208,8 @@ class ChessModel:
         print('debug2')
         if mc.distributed and config_path == resources.model_best_config_path:
             try:
-                print('debug3')
-                logger.debug("saving model to server")
-                ftp_connection = ftplib.FTP(resources.model_best_distributed_ftp_server,
-                                            resources.model_best_distributed_ftp_user,
-                                            resources.model_best_distributed_ftp_password)
-                ftp_connection.cwd(resources.model_best_distributed_ftp_remote_path)
-                fh = open(config_path, 'rb')
-                ftp_connection.storbinary('STOR model_best_config.json', fh)
-                fh.close()
-
-                fh = open(weight_path, 'rb')
-                ftp_connection.storbinary('STOR model_best_weight.h5', fh)
-                fh.close()
-                ftp_connection.quit()
-            except:
-                print('debug4')
-                pass
+                logger.debug("pushing model to the model store")
+                with open_store(self.config) as store:
+                    store.push(config_path, weight_path)
+            except STORE_ERRORS as e:
+                logger.warning("could not push the best model: %s" % e)
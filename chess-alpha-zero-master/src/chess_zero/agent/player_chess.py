@@ -1,4 +1,4 @@
-from collections import defaultdict
+from collections import Counter
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from threading import Lock
@@ -7,9 +7,9 @@ from threading import Lock
 import numpy as np
 
 from chess_zero.config import Config
-from chess_zero.env.chess_env import ChessEnv, Winner, maybe_flip_fen, maybe_flip_moves, flip_move
-from chess_zero.cchess.common import Move
+from chess_zero.env.chess_env import ChessEnv, Winner, maybe_flip_moves, flip_move, canonical_codes
 from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.lib.eval_cache import get_eval_cache
 from time import time
 
 logger = getLogger(__name__)
@@ -17,41 +17,119 @@ logger = getLogger(__name__)
 
 # these are from AGZ nature paper
 class VisitStats:
+    """
+    a node of the search tree. The edge stats N, W, Q and the prior P are float32 arrays aligned
+    with legal_moves (an uint16 array of canonical int moves), so there is no object per edge.
+    """
+    __slots__ = ('legal_moves', 'labels', 'p', 'n', 'w', 'q', 'sum_n', 'visit', 'noise', 'gen')
+
     def __init__(self):
-        self.a = defaultdict(ActionStats)
+        self.legal_moves = None
+        self.labels = None # label index of each legal move
+        self.p = None
+        self.n = None
+        self.w = None
+        self.q = None
         self.sum_n = 0
         self.visit = []
-        self.p = None
-        self.legal_moves = None
+        self.noise = None # dirichlet noise, drawn once when the node is searched as root
+        self.gen = 0 # generation of the search that last touched the node, see SearchTree
 
+    def expand(self, legal_moves, labels, prior):
+        """
+        :param prior: network policy masked to the legal moves (policy[labels]), it is renormalized here
+        """
+        self.legal_moves = np.asarray(legal_moves, dtype=np.uint16)
+        self.labels = labels.astype(np.int16)
+        p = prior.astype(np.float32)
+        self.p = p / np.sum(p)
+        self.n = np.zeros(len(legal_moves), dtype=np.float32)
+        self.w = np.zeros(len(legal_moves), dtype=np.float32)
+        self.q = np.zeros(len(legal_moves), dtype=np.float32)
+
+
+class SearchTree:
+    """
+    transposition table of VisitStats keyed by state_key, used like a defaultdict(VisitStats).
+    Every search starts a new generation and a node is stamped with the generation that last looked it up.
+    When a search starts with more than max_nodes nodes, the oldest generations are dropped, which are the
+    lines the game has left behind. The one before the current search is always kept, it holds the subtree
+    under the new root. Nodes are locked in stripes instead of one lock per node.
+    """
+    def __init__(self, max_nodes=None, lock_stripes=1024):
+        self.nodes = {}
+        self.max_nodes = max_nodes # None for no limit
+        self.generation = 0
+        self.evicted = 0
+        self.locks = [Lock() for _ in range(lock_stripes)]
+
+    def __contains__(self, state):
+        return state in self.nodes
+
+    def __getitem__(self, state):
+        node = self.nodes.get(state)
+        if node is None:
+            node = self.nodes[state] = VisitStats()
+        node.gen = self.generation
+        return node
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def lock(self, state):
+        return self.locks[state % len(self.locks)]
+
+    def next_generation(self):
+        """call before every search, while no search is running on the tree"""
+        self.generation += 1
+        if self.max_nodes is not None and len(self.nodes) > self.max_nodes:
+            self.evict()
+
+    def evict(self):
+        """drop whole generations, oldest first, until at most max_nodes * 3 / 4 nodes are left"""
+        target = self.max_nodes * 3 // 4
+        remaining = len(self.nodes)
+        cutoff = None
+        for gen, count in sorted(Counter(node.gen for node in self.nodes.values()).items()):
+            if remaining <= target or gen >= self.generation - 1:
+                break
+            remaining -= count
+            cutoff = gen
+        if cutoff is not None:
+            self.evicted += len(self.nodes) - remaining
+            self.nodes = {state: node for state, node in self.nodes.items() if node.gen > cutoff}
 
-class ActionStats:
-    def __init__(self):
-        self.n = 0
-        self.w = 0
-        self.q = 0
-        self.p = -1
+    def stats(self):
+        return "%d/%s nodes, %d evicted, generation %d" % (
+            len(self.nodes), self.max_nodes or "-", self.evicted, self.generation)
 
 
 class ChessPlayer:
     # dot = False
-    def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, dummy=False):
-        self.moves = []
+    def __init__(self, config: Config, search_tree=None, pipes=None, play_config=None, dummy=False, model_digest=None,
+                 shared_cache=None):
+        """
+        :param model_digest: digest of the weights behind pipes, evaluations are cached per process under it.
+            None disables the cache. The weights may be swapped during a game, the digest is then updated from
+            the answers of the pipes (see predict)
+        :param SharedEvalCache shared_cache: table shared with the other processes, looked up after the
+            per process cache
+        """
+        self.moves = [] # [fen, (labels, policy), z] of the positions played, the policy sparse (see calc_policy)
 
         self.config = config
         self.play_config = play_config or self.config.play
         self.labels_n = config.n_labels
         self.labels = config.labels
-        # self.move_lookup = {Move.from_uci(move): i for move, i in zip(self.labels, range(self.labels_n))}
-        self.move_lookup = {move: i for move, i in zip(self.labels, range(self.labels_n))}
+        self.label_moves = config.label_moves
+        self.move_lookup = config.move_lookup # indexed by int move
         if dummy:
             return
 
         self.pipe_pool = pipes
-
-        self.node_lock = defaultdict(Lock)
-       
-
+        self.model_digest = model_digest
+        self.eval_cache = get_eval_cache(self.play_config.eval_cache_size) if model_digest is not None else None
+        self.shared_cache = shared_cache if model_digest is not None else None
 
         if search_tree is None:
             self.reset()
@@ -59,39 +137,24 @@ class ChessPlayer:
             self.tree = search_tree
 
     def reset(self):
-        self.tree = defaultdict(VisitStats)
+        self.tree = SearchTree(self.play_config.max_tree_nodes)
 
     def deboog(self, env):
         print(env.testeval())
 
         state = state_key(env)
-        my_visit_stats = self.tree[state]
-        stats = []
-        for action, a_s in my_visit_stats.a.items():
-            moi = self.move_lookup[action]
-            stats.append(np.asarray([a_s.n, a_s.w, a_s.q, a_s.p, moi]))
-        stats = np.asarray(stats)
-        a = stats[stats[:,0].argsort()[::-1]]
-
-        for s in a:
-            # print(f'{self.labels[int(s[4])]:5}: '
-            #       f'n: {s[0]:3.0f} '
-            #       f'w: {s[1]:7.3f} '
-            #       f'q: {s[2]:7.3f} '
-            #       f'p: {s[3]:7.5f}')
-            print('%5d:' % (self.labels[int(s[4])]))
-            print('%3.0f:' % (s[0]))
-            print('%7.3f:' % (s[1]))
-            print('%7.3f:' % (s[2]))
-            print('%7.5f:' % (s[3]))
-
-    def action(self, env, can_stop = True) -> str:
+        node = self.tree[state]
+        for i in np.argsort(node.n)[::-1]:
+            print('%5s: n: %3.0f w: %7.3f q: %7.3f p: %7.5f' %
+                  (self.labels[node.labels[i]], node.n[i], node.w[i], node.q[i], node.p[i]))
+
+    def action(self, env, can_stop = True) -> int:
         #self.reset()
 
         # for tl in range(self.play_config.thinking_loop):
         root_value, naked_value = self.search_moves(env)
-        policy = self.calc_policy(env)
-        my_action = int(np.random.choice(range(self.labels_n), p=self.apply_temperature(policy, env.num_halfmoves)))
+        labels, policy = self.calc_policy(env)
+        my_action = int(labels[np.random.choice(len(labels), p=self.apply_temperature(policy, env.num_halfmoves))])
 
         if can_stop and self.play_config.resign_threshold is not None and \
                         root_value <= self.play_config.resign_threshold \
@@ -99,23 +162,160 @@ class ChessPlayer:
             # noinspection PyTypeChecker
             return None  #for resign return None
         else:
-            self.moves.append([env.observation, list(policy)])
-            return self.config.labels[my_action]
+            self.moves.append([env.observation, (labels.astype(np.uint16), policy.astype(np.float32))])
+            return self.label_moves[my_action]
 
     def search_moves(self, env) -> (float, float):
-        futures = []
-        with ThreadPoolExecutor(max_workers=self.play_config.search_threads) as executor:
-            for i in range(self.play_config.simulation_num_per_move):
-                futures.append(executor.submit(self.search_my_move,env=env.copy(),is_root_node=True, tid=i))
+        """
+        with search_batch_size set, one thread collects leaves and evaluates them in batches (see search_batched).
+        otherwise every search thread walks one private copy of env down and back up the tree,
+        instead of copying the env for each simulation
+        """
+        start_time = time()
+        self.tree.next_generation()
+        num_sims = max(1, self.play_config.simulation_num_per_move) # the first one expands the root
+        if self.play_config.search_batch_size > 0:
+            vals = self.search_batched(env.copy(), num_sims)
+        else:
+            futures = []
+            num_threads = self.play_config.search_threads
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                for i in range(num_threads):
+                    sims = num_sims // num_threads + (1 if i < num_sims % num_threads else 0)
+                    futures.append(executor.submit(self.search_thread, env=env.copy(), sims=sims, tid=i))
 
-        vals = [f.result() for f in futures]
+            vals = [v for f in futures for v in f.result()]
+
+        if self.play_config.logging_thinking:
+            elapsed = time() - start_time
+            logger.debug("%d simulations in %.2fs (%.0f sim/s), tree %s, eval cache %s" %
+                         (len(vals), elapsed, len(vals) / max(elapsed, 1e-9), self.tree.stats(),
+                          self.eval_cache.stats() if self.eval_cache else "off"))
 
         return np.max(vals), vals[0] # vals[0] is kind of racy
 
+    def search_thread(self, env: ChessEnv, sims, tid=0) -> list:
+        return [self.search_my_move(env, is_root_node=True, tid=tid) for _ in range(sims)]
+
+    def search_batched(self, env: ChessEnv, sims) -> list:
+        """
+        descend up to search_batch_size times with virtual loss, send the unexpanded leaves found on the way
+        to the model in one request, then expand them and back up every path. Runs in the calling thread.
+        A batch is cut short when a descent ends on a leaf that is already waiting in it.
+        Leaves found in the evaluation cache are expanded during the descent and take no place in the batch.
+        :return: the value of every simulation, from the POV of the side to move at the root
+        """
+        batch_size = self.play_config.search_batch_size
+        codes = np.empty((batch_size, 10, 9), dtype=np.uint8)
+        vals = []
+        while len(vals) < sims:
+            leaves = {} # state -> (path, legal moves), in the order of the rows of codes
+            while len(vals) + len(leaves) < sims and len(leaves) < batch_size:
+                path, state, legal_moves, leaf_v = self.select_leaf(env, leaves, codes[len(leaves)])
+                if leaf_v is not None:
+                    vals.append(self.backup(path, leaf_v))
+                elif legal_moves is None: # collided with a leaf of this batch
+                    self.revert_virtual_loss(path)
+                    break
+                else:
+                    leaves[state] = (path, legal_moves)
+            if not leaves:
+                continue
+
+            labels = [self.move_lookup[legal_moves] for _, legal_moves in leaves.values()]
+            prior_ary, value_ary, digest = self.predict(codes[:len(leaves)], labels)
+            for (state, (path, legal_moves)), leaf_labels, leaf_p, leaf_v in \
+                    zip(leaves.items(), labels, prior_ary, value_ary):
+                self.tree[state].expand(legal_moves, leaf_labels, leaf_p)
+                self.cache_evaluation(state, leaf_p, float(leaf_v), digest)
+                vals.append(self.backup(path, float(leaf_v)))
+        return vals
+
+    def select_leaf(self, env: ChessEnv, pending, leaf_codes):
+        """
+        walk env from the root to a leaf, adding virtual loss to the edges on the way, and back up to the root
+        :param pending: the leaves already waiting for the network
+        :param leaf_codes: (10, 9) buffer the canonical board of a new leaf is written into
+        :return: (path as a list of (node, index), leaf state, legal moves of a new leaf, leaf value).
+            The value is None when the leaf needs the network, legal moves are None when it is already pending.
+        """
+        if env.done:
+            return [], None, None, 0 if env.winner == Winner.draw else -1
+
+        virtual_loss = self.play_config.virtual_loss
+        path = []
+        on_path = set()
+        legal_moves = None
+        leaf_v = None
+        while True:
+            state = state_key(env)
+            if state in pending:
+                break
+            if state not in self.tree:
+                legal_moves = state_moves(env)
+                if not legal_moves: # mated or stalemated, no need to ask the network
+                    self.tree[state].legal_moves = legal_moves
+                    leaf_v = -1
+                else:
+                    cached = self.cached_evaluation(state, len(legal_moves))
+                    if cached is not None:
+                        prior, leaf_v = cached
+                        self.tree[state].expand(legal_moves, self.move_lookup[legal_moves], prior)
+                    else:
+                        leaf_codes[:] = canonical_codes(env.board)
+                break
+
+            node = self.tree[state]
+            if len(node.legal_moves) == 0:
+                leaf_v = -1
+                break
+            if state in on_path: # loop -> draw
+                leaf_v = 0
+                break
+            on_path.add(state)
+
+            i = self.select_action_q_and_u(node, is_root_node=not path)
+            node.sum_n += virtual_loss
+            node.n[i] += virtual_loss
+            node.w[i] -= virtual_loss
+            node.q[i] = node.w[i] / node.n[i]
+            path.append((node, i))
+
+            canon_action = int(node.legal_moves[i])
+            env.step(canon_action if env.white_to_move else flip_move(canon_action), check_over=False)
+
+        for _ in path:
+            env.pop()
+        return path, state, legal_moves, leaf_v
+
+    def backup(self, path, leaf_v) -> float:
+        """
+        replace the virtual loss along path with the visit
+        :param leaf_v: value from the POV of the side to move at the leaf
+        :return: the value from the POV of the side to move at the root
+        """
+        virtual_loss = self.play_config.virtual_loss
+        for node, i in reversed(path):
+            leaf_v = -leaf_v
+            node.sum_n += 1 - virtual_loss
+            node.n[i] += 1 - virtual_loss
+            node.w[i] += leaf_v + virtual_loss
+            node.q[i] = node.w[i] / node.n[i]
+        return leaf_v
+
+    def revert_virtual_loss(self, path):
+        virtual_loss = self.play_config.virtual_loss
+        for node, i in path:
+            node.sum_n -= virtual_loss
+            node.n[i] -= virtual_loss
+            node.w[i] += virtual_loss
+            node.q[i] = node.w[i] / node.n[i] if node.n[i] > 0 else 0
+
     def search_my_move(self, env: ChessEnv, is_root_node=False, tid=0) -> float:  #dfs to the leaf and back up
         """
         Q, V is value for this Player(always white).
         P is value for the player of next_player (black or white)
+        env is stepped down to the leaf and popped back, so it is unchanged on return
         :return: leaf value
         """
         if env.done:
@@ -125,114 +325,142 @@ class ChessPlayer:
 
         state = state_key(env)
 
-        with self.node_lock[state]:
+        with self.tree.lock(state):
             if state not in self.tree:
-                leaf_p, leaf_v = self.expand_and_evaluate(env)
-                self.tree[state].p = leaf_p
-                self.tree[state].legal_moves = state_moves(env)
+                legal_moves = state_moves(env)
+                if not legal_moves: # mated or stalemated, no need to ask the network
+                    self.tree[state].legal_moves = legal_moves
+                    return -1
+                labels = self.move_lookup[legal_moves]
+                prior, leaf_v = self.expand_and_evaluate(env, state, labels)
+                self.tree[state].expand(legal_moves, labels, prior)
                 return leaf_v # I'm returning everything from the POV of side to move
 
-            if tid in self.tree[state].visit: # loop -> loss
+            node = self.tree[state]
+            if len(node.legal_moves) == 0:
+                return -1
+
+            if tid in node.visit: # loop -> loss
                 return 0
 
-            self.tree[state].visit.append(tid)
+            node.visit.append(tid)
             # SELECT STEP
-            canon_action = self.select_action_q_and_u(state, is_root_node)
+            i = self.select_action_q_and_u(node, is_root_node)
+            canon_action = int(node.legal_moves[i])
 
             virtual_loss = self.config.play.virtual_loss
-            my_visit_stats = self.tree[state]
-            my_visit_stats.sum_n += virtual_loss
-
-            my_stats = my_visit_stats.a[canon_action]
-            my_stats.n += virtual_loss
-            my_stats.w -= virtual_loss
-            my_stats.q = my_stats.w / my_stats.n
+            node.sum_n += virtual_loss
+            node.n[i] += virtual_loss
+            node.w[i] -= virtual_loss
+            node.q[i] = node.w[i] / node.n[i]
 
 
+        # game over is found from the legal moves of the next node, no need to check it on every step
         if env.white_to_move:
-            env.step(canon_action)
+            env.step(canon_action, check_over=False)
         else:
-            env.step(flip_move(canon_action))
+            env.step(flip_move(canon_action), check_over=False)
         leaf_v = self.search_my_move(env,False,tid)  # next move from enemy POV
         leaf_v = -leaf_v
+        env.pop()
 
         # BACKUP STEP
         # on returning search path
         # update: N, W, Q
-        with self.node_lock[state]:
-            my_visit_stats = self.tree[state]
-            my_visit_stats.visit.remove(tid)
-            my_visit_stats.sum_n += 1 - virtual_loss
-
-
-            my_stats = my_visit_stats.a[canon_action]
-            my_stats.n += 1 - virtual_loss
-            my_stats.w += leaf_v + virtual_loss
-            my_stats.q = my_stats.w / my_stats.n
+        with self.tree.lock(state):
+            node.visit.remove(tid)
+            node.sum_n += 1 - virtual_loss
+            node.n[i] += 1 - virtual_loss
+            node.w[i] += leaf_v + virtual_loss
+            node.q[i] = node.w[i] / node.n[i]
 
         return leaf_v
 
-    def expand_and_evaluate(self, env) -> (np.ndarray, float):
+    def expand_and_evaluate(self, env, state, labels) -> (np.ndarray, float):
         """ expand new leaf, this is called only once per state
         this is called with state locked
-        insert P(a|s), return leaf_v
+        :return: P(a|s) masked to the legal moves (given by their labels) and leaf_v
         """
-        state_planes = env.canonical_input_planes()
+        cached = self.cached_evaluation(state, len(labels))
+        if cached is not None:
+            return cached
 
-        leaf_p, leaf_v = self.predict(state_planes)
+        leaf_p, leaf_v, digest = self.predict(canonical_codes(env.board), labels)
         # these are canonical policy and value (i.e. side to move is "white")
-
+        self.cache_evaluation(state, leaf_p, leaf_v, digest)
         return leaf_p, leaf_v
 
-    def predict(self, state_planes):
-        pipe = self.pipe_pool.pop()
-        pipe.send(state_planes)
-        ret = pipe.recv()
-        self.pipe_pool.append(pipe)
-        return ret
-
-    #@profile
-    def select_action_q_and_u(self, state, is_root_node) -> Move:
-
-
-        my_visitstats = self.tree[state]
-        legal_moves = my_visitstats.legal_moves
-
+    def cached_evaluation(self, state, num_moves):
+        """
+        :return: (prior over the legal moves, value) from the evaluation caches, or None
+        """
+        key = (state, self.model_digest)
+        if self.eval_cache is not None:
+            cached = self.eval_cache.get(key)
+            if cached is not None:
+                return cached
+        if self.shared_cache is not None:
+            cached = self.shared_cache.get(key, num_moves)
+            if cached is not None and self.eval_cache is not None:
+                self.eval_cache.put(key, *cached)
+            return cached
+        return None
+
+    def cache_evaluation(self, state, prior, value, digest):
+        """:param digest: of the weights that evaluated state"""
+        if digest is None:
+            return
+        key = (state, digest)
+        if self.eval_cache is not None:
+            self.eval_cache.put(key, prior, value)
+        if self.shared_cache is not None:
+            self.shared_cache.put(key, prior, value)
 
-        if my_visitstats.p is not None: #push p, the prior probability to the edge (my_visitstats.p)
-            tot_p = 0
-            for mov in legal_moves:
-                mov_p = my_visitstats.p[self.move_lookup[mov]]
-                my_visitstats.a[mov].p = mov_p
-                tot_p += mov_p
-            for mov in legal_moves:
-                my_visitstats.a[mov].p /= tot_p
-            my_visitstats.p = None # release the temp policy
+    def predict(self, codes, labels):
+        """
+        :param codes: canonical board codes of one state, or a (N, 10, 9) batch of them.
+            The model side turns them into input planes
+        :param labels: labels of the legal moves of the state, or a list of them for a batch
+        :return: prior over the legal moves (renormalized policy[labels]) and value, or a list of priors
+            and (N,) values for a batch, and the digest of the weights that computed them
+        """
+        pipe = self.pipe_pool.pop()
+        try:
+            prior, value = pipe.predict_boards(codes, labels)
+            digest = pipe.digest
+            # views of the pipe's slot, copied before another search thread can take the pipe
+            if isinstance(prior, list):
+                prior, value = [p.copy() for p in prior], value.copy()
+            else:
+                prior = prior.copy()
+        finally:
+            self.pipe_pool.append(pipe)
+        if self.model_digest is not None and digest is not None:
+            self.model_digest = digest # look up the evaluations of the weights the pipes run now
+        return prior, value, digest
+
+    def select_action_q_and_u(self, node: VisitStats, is_root_node) -> int:
+        """
+        PUCT over the node's arrays in one vectorized pass
+        :return: index into node.legal_moves
+        """
+        win = np.flatnonzero(node.q > (1-1e-7))
+        if len(win) > 0:
+            return int(win[0])
 
-        xx_ = np.sqrt(my_visitstats.sum_n + 1)  # sqrt of sum(N(s, b); for all b)
+        xx_ = np.sqrt(node.sum_n + 1)  # sqrt of sum(N(s, b); for all b)
 
         e = self.play_config.noise_eps
         c_puct = self.play_config.c_puct
         dir_alpha = self.play_config.dirichlet_alpha
 
-        best_s = -999
-        best_a = None
-
-
-        for action in legal_moves:
-            a_s = my_visitstats.a[action]
-            p_ = a_s.p
-            if is_root_node:
-                p_ = (1-e) * p_ + e * np.random.dirichlet([dir_alpha])
-            b = a_s.q + c_puct * p_ * xx_ / (1 + a_s.n)
-            if a_s.q > (1-1e-7):
-                best_a = action
-                break
-            if b > best_s:
-                best_s = b
-                best_a = action
-
-        return best_a
+        p_ = node.p
+        if is_root_node and e > 0:
+            if node.noise is None:
+                node.noise = np.random.dirichlet([dir_alpha] * len(p_))
+            p_ = (1-e) * p_ + e * node.noise
+        b = node.q + c_puct * p_ * xx_ / (1 + node.n)
+        return int(np.argmax(b))
 
     def apply_temperature(self, policy, turn):
         tau = np.power(self.play_config.tau_decay_rate, turn + 1)
@@ -240,7 +468,7 @@ class ChessPlayer:
             tau = 0
         if tau == 0:
             action = np.argmax(policy)
-            ret = np.zeros(self.labels_n)
+            ret = np.zeros(len(policy))
             ret[action] = 1.0
             return ret
         else:
@@ -250,27 +478,29 @@ class ChessPlayer:
 
     def calc_policy(self, env):
         """calc π(a|s0)
-        :return:
+        :return: the labels of the visited moves (flipped back for black, like the moves played) and their
+            share of the visits. When no move was visited (a single simulation), the labels of the legal moves
+            and their prior.
         """
         state = state_key(env)
-        my_visitstats = self.tree[state]
-        policy = np.zeros(self.labels_n)
-        for action, a_s in my_visitstats.a.items():
-            policy[self.move_lookup[action]] = a_s.n
+        node = self.tree[state]
+        visited = node.n > 0
+        if np.any(visited):
+            labels = node.labels[visited]
+            policy = node.n[visited].astype(np.float64)
+        else:
+            labels = node.labels
+            policy = node.p.astype(np.float64)
 
         policy /= np.sum(policy)
 
         if not env.white_to_move:
-            policy = Config.flip_policy(policy)
-        return policy
+            labels = Config.unflipped_index[labels]
+        return labels, policy
 
     def sl_action(self, observation, my_action, weight=1):
-        policy = np.zeros(self.labels_n)
-
-        k = self.move_lookup[Move.from_uci(my_action)]
-        policy[k] = weight
-
-        self.moves.append([observation, list(policy)])
+        k = self.move_lookup[my_action]
+        self.moves.append([observation, (np.array([k], dtype=np.uint16), np.array([weight], dtype=np.float32))])
         return my_action
 
     def finish_game(self, z):
@@ -283,11 +513,19 @@ class ChessPlayer:
             move += [z]
 
 
-def state_key(env: ChessEnv) -> str:
-    fen = env.board.fen()
-    fen = maybe_flip_fen(fen)
-    fen = fen.split(' ') # drop the move clock
-    return fen[0]
+def search_pipes(model, play_config) -> list:
+    """
+    pipes to model for one player: one per search thread, or a single one for the batched search
+    :param chess_zero.agent.model_chess.ChessModel model:
+    """
+    if play_config.search_batch_size > 0:
+        return model.get_pipes(1, max_states=play_config.search_batch_size)
+    return model.get_pipes(play_config.search_threads)
+
+
+def state_key(env: ChessEnv) -> int:
+    """zobrist hash of the canonical (side to move is red) board, kept up to date by the board itself"""
+    return env.board.canonical_hash()
 
 def state_moves(env: ChessEnv):
     moves = env.board.legal_moves
@@ -0,0 +1,81 @@
+from logging import getLogger
+from multiprocessing.connection import Client
+from threading import Lock
+
+from chess_zero.agent.api_chess import SlotPipe
+from chess_zero.config import Config
+from chess_zero.lib.model_helper import fetch_digest
+
+logger = getLogger(__name__)
+
+
+class RemoteChessModel:
+    """
+    stands in for ChessModel when the network runs in the inference server (cmd serve). The server hosts
+    one network per digest, this model is a name there bound to one of them: load, build and save are
+    done by the server, and the pipes are sockets to it, batched together with those of every other client.
+    Never imports tensorflow.
+    """
+    def __init__(self, config: Config):
+        self.config = config
+        self.digest = None
+        self.address = config.resource.inference_socket_path
+        self.key_path = config.resource.inference_key_path
+        self.conn = None # control connection, the server drops the name when it closes
+        self.name = None
+        self.lock = Lock()
+
+    fetch_digest = staticmethod(fetch_digest)
+
+    def connect(self):
+        """:return: a connection to the server, authenticated with the key of its current run"""
+        return Client(self.address, family='AF_UNIX', authkey=read_authkey(self.key_path))
+
+    def call(self, *request):
+        with self.lock:
+            if self.conn is None:
+                self.conn = self.connect()
+                self.conn.send(('control',))
+                self.name = self.conn.recv()
+                logger.debug("connected to inference server %s as %s" % (self.address, self.name))
+            self.conn.send(request)
+            ret = self.conn.recv()
+        if isinstance(ret, Exception):
+            raise ret
+        return ret
+
+    def get_pipes(self, num=1, max_states=1):
+        """
+        :param max_states: the most states a pipe sends in one request
+        """
+        if self.name is None:
+            self.call('ping')
+        pipes = []
+        for _ in range(num):
+            conn = self.connect()
+            conn.send(('pipe', self.name, max_states))
+            shm_name, n_labels = conn.recv()
+            pipes.append(SlotPipe(conn, shm_name, max_states, n_labels))
+        return pipes
+
+    def build(self):
+        self.digest = self.call('build')
+
+    def load(self, config_path, weight_path):
+        digest = self.call('load', config_path, weight_path)
+        if digest is None: # nothing to load, the name stays bound to what it had
+            return False
+        self.digest = digest
+        return True
+
+    def save(self, config_path, weight_path):
+        self.digest = self.call('save', config_path, weight_path)
+
+
+def read_authkey(key_path):
+    """:return: the key cmd serve wrote for its clients"""
+    try:
+        with open(key_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise RuntimeError("no inference server key at %s, is cmd serve running?" % key_path)
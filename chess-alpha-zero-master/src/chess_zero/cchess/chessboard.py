@@ -21,27 +21,37 @@ from chess_zero.cchess.common import *
 
 
 class Chessboard:
+    """
+    The board is a flat bytearray of 90 squares (square = y * 9 + x) holding the
+    FEN letter of the piece (or EMPTY). Moves are ints (see make_move), legal_moves
+    returns them and push takes them. push/pop keep an undo stack, so a search
+    can walk down and back up one board instead of copying it.
+    push also updates two zobrist hashes incrementally: one of the board as it is and
+    one of the board mirrored for black (see ZOBRIST_MIRROR).
+    """
 
     def __init__(self, board=None):
-        if (board is None):
-            self.height = 10
-            self.width = 9
-            self.board = [['.' for col in range(self.width)] for row in range(self.height)]
-            self.assign_fen(None)
+        self.height = 10
+        self.width = 9
+        if board is None or isinstance(board, str):
+            self.board = bytearray(self.height * self.width)
+            self.assign_fen(board)
         else:
             self.turn = board.turn
-            # self.history = board.history.copy()
-            # self.ate = board.ate.copy()
+            self.steps = board.steps
             self.height = board.height
             self.width = board.width
-            self.board = board.board.copy()
-        self.steps = 0
+            self.board = bytearray(board.board)
+            self._stack = list(board._stack)
+            self._hash = board._hash
+            self._mirror_hash = board._mirror_hash
+            self._legal_moves = board._legal_moves
+            self._fen = board._fen
 
     def _resign(self):
         self.turn = RED
         self.steps = 0
-        # self.history = []
-        # self.ate = []
+        self._stack = []
         self._legal_moves = None
         self._fen = None
 
@@ -49,27 +59,22 @@ class Chessboard:
         self._fen = None
         self._legal_moves = None
         self.steps += 1
-        if self.steps%2 == 0:
-            self.turn = RED
-        else:
-            self.turn = BLACK
-
+        self.turn = BLACK if self.turn == RED else RED
 
     def fen(self):
         if self._fen is not None:
             return self._fen
 
-        c = 0
         fen = ''
         for i in range(self.height):
             c = 0
-            for j in range(self.width):
-                if self.board[i][j] == '.':
+            for ch in self.board[i*self.width:(i+1)*self.width]:
+                if ch == EMPTY:
                     c = c+1
                 else:
                     if (c > 0):
                         fen = fen+str(c)
-                    fen = fen+self.board[i][j]
+                    fen = fen+chr(ch)
                     c = 0
             if (c > 0):
                 fen = fen + str(c)
@@ -85,109 +90,167 @@ class Chessboard:
 
     @property
     def legal_moves(self):
+        """
+        strictly legal moves: pseudo legal moves from the static tables, minus those leaving
+        the own king attacked (including kings facing each other on an open file)
+        """
         if self._legal_moves is not None:
             return self._legal_moves
 
-        legal_moves = []
-        for y in range(self.height):
-            for x in range(self.width):
-                ch = self.board[y][x]
-                if (self.turn == RED and ch.isupper()):
+        color = self.turn
+        king_sq = self._king_square(color)
+        pseudo = self._pseudo_legal_moves(color)
+        if king_sq < 0:
+            legal = pseudo
+        elif self._is_attacked(king_sq, color):
+            legal = [m for m in pseudo if self._is_safe(m >> 7, m & 127, color)]
+        else:
+            # only a move touching the king's lines (or the king itself) can expose it, all others are legal
+            exposure = KING_EXPOSURE[king_sq]
+            legal = [m for m in pseudo if ((m >> 7) not in exposure and (m & 127) not in exposure)
+                     or self._is_safe(m >> 7, m & 127, color)]
+
+        self._legal_moves = legal
+        return self._legal_moves
+
+    def _pseudo_legal_moves(self, color):
+        board = self.board
+        red = color == RED
+        moves = []
+        for sq in range(90):
+            code = board[sq]
+            if code == EMPTY or (code >= LOWER_CASE) != red:
+                continue
+            kind = code | 32 # lower case letter
+            if kind == ROOK_CODE or kind == CANNON_CODE:
+                for ray in RAYS[sq]:
+                    screen = False
+                    for to in ray:
+                        t = board[to]
+                        if not screen:
+                            if t == EMPTY:
+                                moves.append(sq << 7 | to)
+                                continue
+                            if kind == ROOK_CODE:
+                                if (t >= LOWER_CASE) != red:
+                                    moves.append(sq << 7 | to)
+                                break
+                            screen = True
+                        elif t != EMPTY:
+                            if (t >= LOWER_CASE) != red:
+                                moves.append(sq << 7 | to)
+                            break
+                continue
+            if kind == KNIGHT_CODE:
+                targets = [to for to, leg in KNIGHT_MOVES[sq] if board[leg] == EMPTY]
+            elif kind == PAWN_CODE:
+                targets = PAWN_MOVES[color][sq]
+            elif kind == BISHOP_CODE:
+                targets = [to for to, eye in BISHOP_MOVES[color][sq] if board[eye] == EMPTY]
+            elif kind == ADVISOR_CODE:
+                targets = ADVISOR_MOVES[color][sq]
+            else:
+                targets = KING_MOVES[color][sq]
+                enemy_king = self._flying_king(sq, color)
+                if enemy_king >= 0:
+                    moves.append(sq << 7 | enemy_king)
+            for to in targets:
+                t = board[to]
+                if t == EMPTY or (t >= LOWER_CASE) != red:
+                    moves.append(sq << 7 | to)
+        return moves
+
+    def _king_square(self, color):
+        return self.board.find(KING_RED if color == RED else KING_BLACK)
+
+    def _flying_king(self, sq, color):
+        """square of the enemy king if it faces the king on sq along an open file, else -1"""
+        enemy_king = KING_BLACK if color == RED else KING_RED
+        for to in RAYS[sq][3 if color == RED else 2]:
+            t = self.board[to]
+            if t != EMPTY:
+                return to if t == enemy_king else -1
+        return -1
+
+    def _is_attacked(self, sq, color):
+        """whether the piece of color on sq is attacked by the other side"""
+        board = self.board
+        red = color == RED
+        enemy = BLACK if red else RED
+        for ray in RAYS[sq]:
+            screen = False
+            for to in ray:
+                t = board[to]
+                if t == EMPTY:
                     continue
-                if (self.turn == BLACK and ch.islower()):
+                if (t >= LOWER_CASE) == red:
+                    if screen:
+                        break
+                    screen = True
                     continue
-                if ch in mov_dir:
-                    if (x == 0 and y == 3):
-                        aa = 3
-                    for d in mov_dir[ch]:
-                        x_ = x + d[0]
-                        y_ = y + d[1]
-                        if not self._can_move(x_, y_):
-                            continue
-                        elif ch == 'p' and y < 5 and x_ != x:  # for red pawn
-                            continue
-                        elif ch == 'P' and y > 4 and x_ != x:  # for black pawn
-                            continue
-                        elif ch == 'n' or ch == 'N' or ch == 'b' or ch == 'B': # for knight and bishop
-                            if self.board[y+int(d[1]/2)][x+int(d[0]/2)] != '.':
-                                continue
-                            elif ch == 'b' and y_ > 4:
-                                continue
-                            elif ch == 'B' and y_ < 5:
-                                continue
-                        elif ch != 'p' and ch != 'P': # for king and advisor
-                            if x_ < 3 or x_ > 5:
-                                continue
-                            if (ch == 'k' or ch == 'a') and y_ > 2:
-                                continue
-                            if (ch == 'K' or ch == 'A') and y_ < 7:
-                                continue
-                        legal_moves.append(move_to_str(x, y, x_, y_))
-                        if (ch == 'k' and self.turn == RED): #for King to King check
-                            d, u = self._y_board_from(x, y)
-                            if (u < self.height and self.board[u][x] == 'K'):
-                                legal_moves.append(move_to_str(x, y, x, u))
-                        elif (ch == 'K' and self.turn == BLACK):
-                            d, u = self._y_board_from(x, y)
-                            if (d > -1 and self.board[d][x] == 'k'):
-                                legal_moves.append(move_to_str(x, y, x, d))
-                elif ch != '.': # for connon and root
-                    l,r = self._x_board_from(x,y)
-                    d,u = self._y_board_from(x,y)
-                    for x_ in range(l+1,x):
-                        legal_moves.append(move_to_str(x, y, x_, y))
-                    for x_ in range(x+1,r):
-                        legal_moves.append(move_to_str(x, y, x_, y))
-                    for y_ in range(d+1,y):
-                        legal_moves.append(move_to_str(x, y, x, y_))
-                    for y_ in range(y+1,u):
-                        legal_moves.append(move_to_str(x, y, x, y_))
-                    if ch == 'r' or ch == 'R': # for root
-                        if self._can_move(l, y):
-                            legal_moves.append(move_to_str(x, y, l, y))
-                        if self._can_move(r, y):
-                            legal_moves.append(move_to_str(x, y, r, y))
-                        if self._can_move(x, d):
-                            legal_moves.append(move_to_str(x, y, x, d))
-                        if self._can_move(x, u):
-                            legal_moves.append(move_to_str(x, y, x, u))
-                    else: # for connon
-                        l_, _ = self._x_board_from(l,y)
-                        _, r_ = self._x_board_from(r,y)
-                        d_, _ = self._y_board_from(x,d)
-                        _, u_ = self._y_board_from(x,u)
-                        if self._can_move(l_, y):
-                            legal_moves.append(move_to_str(x, y, l_, y))
-                        if self._can_move(r_, y):
-                            legal_moves.append(move_to_str(x, y, r_, y))
-                        if self._can_move(x, d_):
-                            legal_moves.append(move_to_str(x, y, x, d_))
-                        if self._can_move(x, u_):
-                            legal_moves.append(move_to_str(x, y, x, u_))
+                kind = t | 32
+                if screen:
+                    if kind == CANNON_CODE:
+                        return True
+                    break
+                if kind == ROOK_CODE or (kind == KING_CODE and to % 9 == sq % 9):
+                    return True
+                screen = True
+        for knight_sq, leg in KNIGHT_ATTACKS[sq]:
+            t = board[knight_sq]
+            if t != EMPTY and (t | 32) == KNIGHT_CODE and (t >= LOWER_CASE) != red and board[leg] == EMPTY:
+                return True
+        for pawn_sq in PAWN_ATTACKS[enemy][sq]:
+            t = board[pawn_sq]
+            if t != EMPTY and (t | 32) == PAWN_CODE and (t >= LOWER_CASE) != red:
+                return True
+        return False
 
-        self._legal_moves = legal_moves
-        return self._legal_moves
+    def _is_safe(self, frm, to, color):
+        """make the move on the raw array, test the own king and take it back"""
+        board = self.board
+        ate = board[to]
+        board[to] = board[frm]
+        board[frm] = EMPTY
+        safe = not self._is_attacked(self._king_square(color), color)
+        board[frm] = board[to]
+        board[to] = ate
+        return safe
+
+    def is_check(self):
+        """whether the side to move is in check"""
+        king_sq = self._king_square(self.turn)
+        return king_sq >= 0 and self._is_attacked(king_sq, self.turn)
 
     def is_legal(self, mov):
-        return mov.uci in self.legal_moves
+        return mov in self.legal_moves
 
     def push_uci(self, uci):
-        mov = Move(uci)
-        self.push(mov)
+        self.push(uci_to_move(uci))
 
     def push(self, mov):
-        # if self.is_legal(mov):
-        # self.ate.append(self.board[mov.n[1]][mov.n[0]])
-        self.board[mov.n[1]][mov.n[0]] = self.board[mov.p[1]][mov.p[0]]
-        self.board[mov.p[1]][mov.p[0]] = '.'
-        # self.history.append(mov)
+        frm = mov >> 7
+        to = mov & 127
+        piece = self.board[frm]
+        ate = self.board[to]
+        self._stack.append((mov, ate, self._legal_moves, self._fen, self._hash, self._mirror_hash))
+        self._hash ^= ZOBRIST[piece*90 + frm] ^ ZOBRIST[piece*90 + to] ^ ZOBRIST[ate*90 + to]
+        self._mirror_hash ^= ZOBRIST_MIRROR[piece*90 + frm] ^ ZOBRIST_MIRROR[piece*90 + to] ^ ZOBRIST_MIRROR[ate*90 + to]
+        self.board[to] = piece
+        self.board[frm] = EMPTY
         self._update()
 
-    # def pop(self):
-    #     mov = self.history.pop()
-    #     self.board[mov.p[1]][mov.p[0]] = self.board[mov.n[1]][mov.n[0]]
-    #     self.board[mov.n[1]][mov.n[0]] = self.ate.pop()
-    #     self._update()
+    def pop(self):
+        mov, ate, legal_moves, fen, self._hash, self._mirror_hash = self._stack.pop()
+        frm = mov >> 7
+        to = mov & 127
+        self.board[frm] = self.board[to]
+        self.board[to] = ate
+        self.steps -= 1
+        self.turn = BLACK if self.turn == RED else RED
+        self._legal_moves = legal_moves
+        self._fen = fen
+        return mov
 
     def assign_fen(self, fen):
         self._resign()
@@ -206,54 +269,43 @@ class Chessboard:
                 y += 1
             elif ch >= '1' and ch <= '9':
                 for i in range(int(ch)):
-                    self.board[y][x] = '.'
+                    self.board[y*self.width + x] = EMPTY
                     x = x+1
             else:
-                self.board[y][x] = ch
+                self.board[y*self.width + x] = ord(ch)
                 x = x+1
         self._fen = fen
+        self._hash = 0
+        self._mirror_hash = 0
+        for sq, code in enumerate(self.board):
+            self._hash ^= ZOBRIST[code*90 + sq]
+            self._mirror_hash ^= ZOBRIST_MIRROR[code*90 + sq]
 
-    def _is_same_side(self,x,y):
-        if self.turn == RED and self.board[y][x].islower():
-            return True
-        if self.turn == BLACK and self.board[y][x].isupper():
-            return True
+    def zobrist_hash(self):
+        """64 bit hash of the position, side to move included"""
+        if self.turn == RED:
+            return self._hash
+        return self._hash ^ ZOBRIST_BLACK_TURN
 
-    def _can_move(self,x,y): # basically check the move
-        if x < 0 or x > self.width-1:
-            return False
-        if y < 0 or y > self.height-1:
-            return False
-        if self._is_same_side(x,y):
-            return False
-        return True
-
-    def _x_board_from(self,x,y):
-        l = x-1
-        r = x+1
-        while l > -1 and self.board[y][l] == '.':
-            l = l-1
-        while r < self.width and self.board[y][r] == '.':
-            r = r+1
-        return l,r
-
-    def _y_board_from(self,x,y):
-        d = y-1
-        u = y+1
-        while d > -1 and self.board[d][x] == '.':
-            d = d-1
-        while u < self.height and self.board[u][x] == '.':
-            u = u+1
-        return d,u
+    def canonical_hash(self):
+        """64 bit hash of the position seen from the side to move, i.e. of the board flipped for black"""
+        if self.turn == RED:
+            return self._hash
+        return self._mirror_hash
 
     def result(self, claim_draw=True) -> str:
         rst = '*'
-        if ('k' not in self.board[0]) and ('k' not in self.board[1]) and ('k' not in self.board[2]):
+        if KING_RED not in self.board:
             rst = '0-1'
-        if ('K' not in self.board[9]) and ('K' not in self.board[8]) and ('K' not in self.board[7]):
+        elif KING_BLACK not in self.board:
             rst = '1-0'
+        elif not self.legal_moves: # checkmated or stalemated, both lose in xiangqi
+            rst = '0-1' if self.turn == RED else '1-0'
         return rst
 
+    def is_game_over(self):
+        return self.result() != '*'
+
 if __name__ == '__main__': # test
     board = Chessboard()
     print(board.legal_moves)
\ No newline at end of file
@@ -18,6 +18,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # import pygame
+import random
 
 size = (WIDTH, HEIGHT) = (530, 586)
 
@@ -49,6 +50,35 @@ chessman_image = ['king.png',
 # init_fen = '3aka3/9/C7n/2p4r1/2n6/P3p2pP/2P3P2/R2RK3B/9/3A1A3 r - - 0 1'
 # init_fen = 'rn2ka1nr/4a4/bc2C4/2p1p1p1p/p2c5/2B6/P1P1P1P1P/1C7/9/RN1AKABNR r - - 0 1'
 init_fen = 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR r - - 0 1'
+
+# board array codes: a square holds the ascii code of its FEN letter, red pieces are lower case
+EMPTY = 0
+LOWER_CASE = ord('a')
+KING_RED = ord('k')
+KING_BLACK = ord('K')
+# lower case codes of the piece kinds, code | 32 maps both colors onto them
+KING_CODE, ADVISOR_CODE, BISHOP_CODE, KNIGHT_CODE, ROOK_CODE, CANNON_CODE, PAWN_CODE = map(ord, 'kabnrcp')
+
+
+def flip_square(sq):
+    """mirror a square across the river (y -> 9 - y), the canonical flip used for the side to move"""
+    return (9 - sq // 9) * 9 + sq % 9
+
+
+# zobrist keys, indexed by code * 90 + square. Seeded so every process agrees on the hashes.
+# ZOBRIST_MIRROR[code * 90 + sq] is the key of the swapped-case piece on the flipped square,
+# so xor-ing it in keeps the hash of the canonical (side to move is red) board up to date.
+_zobrist_rng = random.Random(0x5eed)
+ZOBRIST = [0] * (128 * 90)
+for _ch in 'KABNRCPkabnrcp':
+    for _sq in range(90):
+        ZOBRIST[ord(_ch) * 90 + _sq] = _zobrist_rng.getrandbits(64)
+ZOBRIST_MIRROR = [0] * (128 * 90)
+for _ch in 'KABNRCPkabnrcp':
+    for _sq in range(90):
+        ZOBRIST_MIRROR[ord(_ch) * 90 + _sq] = ZOBRIST[ord(_ch.swapcase()) * 90 + flip_square(_sq)]
+ZOBRIST_BLACK_TURN = _zobrist_rng.getrandbits(64)
+
 mov_dir = {
     'k': [(0, -1), (1, 0), (0, 1), (-1, 0)],
     'K': [(0, -1), (1, 0), (0, 1), (-1, 0)],
@@ -64,6 +94,113 @@ mov_dir = {
 bishop_check = [(-1, -1), (1, -1), (-1, 1), (1, 1)]
 knight_check = [(0, -1), (0, -1), (1, 0), (1, 0), (0, 1), (0, 1), (-1, 0), (-1, 0)]
 
+
+# static move tables, indexed by square (and color for the pieces bound to their own side).
+# red owns rows 0-4 (palace rows 0-2), black owns rows 5-9 (palace rows 7-9).
+def _on_board(x, y):
+    return 0 <= x < 9 and 0 <= y < 10
+
+
+def _in_palace(color, x, y):
+    if x < 3 or x > 5:
+        return False
+    return 0 <= y <= 2 if color == RED else 7 <= y <= 9
+
+
+def _on_own_side(color, y):
+    return y <= 4 if color == RED else y >= 5
+
+
+def _build_move_tables():
+    king = ([], [])
+    advisor = ([], [])
+    bishop = ([], [])  # (to, eye)
+    pawn = ([], [])
+    knight = []  # (to, leg)
+    rays = []  # 4 lists of squares walking away from the square
+    for sq in range(90):
+        x, y = sq % 9, sq // 9
+        for color in (RED, BLACK):
+            king[color].append([(y+dy)*9 + x+dx for dx, dy in mov_dir['k']
+                                if _in_palace(color, x+dx, y+dy)])
+            advisor[color].append([(y+dy)*9 + x+dx for dx, dy in mov_dir['a']
+                                   if _in_palace(color, x+dx, y+dy)])
+            bishop[color].append([((y+dy)*9 + x+dx, (y+dy//2)*9 + x+dx//2) for dx, dy in mov_dir['b']
+                                  if _on_board(x+dx, y+dy) and _on_own_side(color, y+dy)])
+            forward = 1 if color == RED else -1
+            steps = [(0, forward)]
+            if not _on_own_side(color, y): # crossed the river
+                steps += [(-1, 0), (1, 0)]
+            pawn[color].append([(y+dy)*9 + x+dx for dx, dy in steps if _on_board(x+dx, y+dy)])
+        knight.append([((y+dy)*9 + x+dx, (y+int(dy/2))*9 + x+int(dx/2)) for dx, dy in mov_dir['n']
+                       if _on_board(x+dx, y+dy)])
+        ray_list = []
+        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+            ray = []
+            x_, y_ = x+dx, y+dy
+            while _on_board(x_, y_):
+                ray.append(y_*9 + x_)
+                x_, y_ = x_+dx, y_+dy
+            ray_list.append(ray)
+        rays.append(ray_list)
+
+    # the reverse tables answer "who can attack this square": (knight square, its leg) and pawn squares
+    knight_attacks = [[] for _ in range(90)]
+    for sq in range(90):
+        for to, leg in knight[sq]:
+            knight_attacks[to].append((sq, leg))
+    pawn_attacks = ([[] for _ in range(90)], [[] for _ in range(90)])
+    for color in (RED, BLACK):
+        for sq in range(90):
+            for to in pawn[color][sq]:
+                pawn_attacks[color][to].append(sq)
+    return king, advisor, bishop, knight, pawn, rays, knight_attacks, pawn_attacks
+
+
+KING_MOVES, ADVISOR_MOVES, BISHOP_MOVES, KNIGHT_MOVES, PAWN_MOVES, RAYS, KNIGHT_ATTACKS, PAWN_ATTACKS = \
+    _build_move_tables()
+
+# squares a moved piece must touch (leave or land on) to possibly expose its own king:
+# the king's rank and file (rooks, cannon screens, facing kings) and its diagonal neighbours (knight legs)
+KING_EXPOSURE = []
+for _sq in range(90):
+    _x, _y = _sq % 9, _sq // 9
+    KING_EXPOSURE.append(frozenset([s for s in range(90) if s % 9 == _x or s // 9 == _y] +
+                                   [(_y+dy)*9 + _x+dx for dx, dy in mov_dir['a'] if _on_board(_x+dx, _y+dy)]))
+
+SQUARE_NAMES = [chr(ord('a') + sq % 9) + str(sq // 9) for sq in range(90)]
+SQUARE_INDEX = {name: sq for sq, name in enumerate(SQUARE_NAMES)}
+
+# moves are ints: from_square << 7 | to_square (fits an uint16). UCI strings only at the protocol edge.
+MOVE_SPACE = 90 << 7
+
+
+def make_move(frm, to):
+    return frm << 7 | to
+
+
+def move_from(mov):
+    return mov >> 7
+
+
+def move_to(mov):
+    return mov & 127
+
+
+def uci_to_move(uci):
+    return SQUARE_INDEX[uci[0:2]] << 7 | SQUARE_INDEX[uci[2:4]]
+
+
+def move_to_uci(mov):
+    return SQUARE_NAMES[mov >> 7] + SQUARE_NAMES[mov & 127]
+
+
+# the move seen from the other side of the river, see flip_square
+FLIPPED_MOVE = [0] * MOVE_SPACE
+for _frm in range(90):
+    for _to in range(90):
+        FLIPPED_MOVE[_frm << 7 | _to] = flip_square(_frm) << 7 | flip_square(_to)
+
 def get_kind(fen_ch):
     if fen_ch in ['k', 'K']:
         return KING
@@ -115,14 +252,3 @@ def str_to_move(move_str):
     move_arr[2] = ord(move_str[2]) - ord('a')
     move_arr[3] = ord(move_str[3]) - ord('0')
     return move_arr
-
-class Move:
-    def __init__(self, uci:str):
-        s = str_to_move(uci)
-        self.p = (s[0],s[1])
-        self.n = (s[2],s[3])
-        self.uci = uci
-    @staticmethod
-    def from_uci(uci):
-        return Move(uci)
-
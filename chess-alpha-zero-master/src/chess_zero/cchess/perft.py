@@ -0,0 +1,48 @@
+"""
+perft counts the leaves of the legal move tree to a fixed depth, the usual way to check a move generator.
+"""
+from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.cchess.common import init_fen, move_to_uci
+
+# positions in this repo's orientation (red is lower case on rows 0-4) with their node counts for depth 1, 2, ...
+# the start position is the published one, the others were cross-checked with a brute force generator
+REFERENCE_POSITIONS = [
+    ('start', init_fen,
+     [44, 1920, 79666, 3290240]),
+    ('middlegame', '2bakab2/9/1cCc5/p1p2r2p/6p2/4C4/PnP1P1P1P/2N1B4/4KN3/R1BA1A3 r - - 0 1',
+     [38, 1128, 43929, 1339047]),
+    ('knights', '3a1k1n1/2c6/3ab4/6pcp/2N2n3/5CP2/2P1P3P/N2A5/9/1CBAK4 r - - 0 1',
+     [7, 281, 8620, 326201]),
+    ('rook ending', '2bc2b2/5k3/3a1a3/9/5N3/5R3/9/3Ar4/3K5/5A3 r - - 0 1',
+     [25, 424, 9850, 202884]),
+    ('cannon screen', '4ka3/4a4/4b4/9/9/2NR5/9/4BA3/3CA4/crn1K1B2 r - - 0 1',
+     [28, 516, 14808, 395483]),
+    ('pins', '4ka3/4a4/4b4/9/2b6/2NR5/9/3ABA3/9/r1n1K1B2 r - - 0 1',
+     [21, 364, 7626, 162837]),
+]
+
+
+def perft(board: Chessboard, depth):
+    if depth == 0:
+        return 1
+    moves = board.legal_moves
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for mov in moves:
+        board.push(mov)
+        nodes += perft(board, depth - 1)
+        board.pop()
+    return nodes
+
+
+def divide(board: Chessboard, depth):
+    """
+    :return: list of (uci move, nodes below it), to find which root move a wrong count comes from
+    """
+    rst = []
+    for mov in board.legal_moves:
+        board.push(mov)
+        rst.append((move_to_uci(mov), perft(board, depth - 1)))
+        board.pop()
+    return rst
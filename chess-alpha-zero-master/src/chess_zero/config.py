@@ -1,6 +1,8 @@
 import os
 import numpy as np
 
+from chess_zero.cchess.common import MOVE_SPACE, uci_to_move
+
 
 class PlayWithHumanConfig:
     def __init__(self):
@@ -18,6 +20,7 @@ class PlayWithHumanConfig:
         """
         pc.simulation_num_per_move = self.simulation_num_per_move
         pc.search_threads *= self.threads_multiplier
+        pc.search_batch_size *= self.threads_multiplier
         pc.c_puct = self.c_puct
         pc.noise_eps = self.noise_eps
         pc.tau_decay_rate = self.tau_decay_rate
@@ -27,6 +30,11 @@ class PlayWithHumanConfig:
 
 class Options:
     new = False
+    bench_suite = "all"
+    bench_depth = 3
+    server = False # run the network in the inference server (cmd serve) instead of in this process
+    export_format = "npz"
+    export_dtype = "fp16"
 
 
 class ResourceConfig:
@@ -38,10 +46,11 @@ class ResourceConfig:
         self.model_best_config_path = os.path.join(self.model_dir, "model_best_config.json")
         self.model_best_weight_path = os.path.join(self.model_dir, "model_best_weight.h5")
 
-        self.model_best_distributed_ftp_server = "alpha-chess-zero.mygamesonline.org"
-        self.model_best_distributed_ftp_user = "2537576_chess"
-        self.model_best_distributed_ftp_password = "alpha-chess-zero-2"
-        self.model_best_distributed_ftp_remote_path = "/alpha-chess-zero.mygamesonline.org/"
+        # where distributed mode pulls and pushes the best model: a directory, or host:port of a cmd store
+        self.model_store_dir = os.path.join(self.data_dir, "model_store")
+        self.model_store = os.environ.get("MODEL_STORE", self.model_store_dir)
+        self.model_store_listen = os.environ.get("MODEL_STORE_LISTEN", "localhost:5480") # cmd store serves model_store_dir here
+        self.model_store_key = os.environ.get("MODEL_STORE_KEY") # authenticates the clients of cmd store when set
 
         self.next_generation_model_dir = os.path.join(self.model_dir, "next_generation")
         self.next_generation_model_dirname_tmpl = "model_%s"
@@ -49,7 +58,13 @@ class ResourceConfig:
         self.next_generation_model_weight_filename = "model_weight.h5"
 
         self.play_data_dir = os.path.join(self.data_dir, "play_data")
-        self.play_data_filename_tmpl = "play_%s.json"
+        self.play_data_filename_tmpl = "play_%s.shard" # see lib.shard
+        self.play_data_json_filename_tmpl = "play_%s.json" # the format before shards, cmd convert turns them into shards
+
+        # cmd serve keeps its socket and the key its clients authenticate with in here, readable by this user only
+        self.inference_dir = os.environ.get("INFERENCE_DIR", os.path.join(self.data_dir, "inference"))
+        self.inference_socket_path = os.path.join(self.inference_dir, "inference.sock")
+        self.inference_key_path = os.path.join(self.inference_dir, "authkey")
 
         self.log_dir = os.path.join(self.project_dir, "logs")
         self.main_log_path = os.path.join(self.log_dir, "main.log")
@@ -148,6 +163,8 @@ class Config:
     n_labels = int(len(labels))
     flipped_labels = flipped_uci_labels()
     unflipped_index = None
+    label_moves = None  # the int move of each label
+    move_lookup = None  # array of the label index of each int move, -1 for moves without a label
 
     def __init__(self, config_type="mini"):
         self.opts = Options()
@@ -169,13 +186,22 @@ class Config:
         self.labels = Config.labels
         self.n_labels = Config.n_labels
         self.flipped_labels = Config.flipped_labels
+        self.label_moves = Config.label_moves
+        self.move_lookup = Config.move_lookup
 
     @staticmethod
     def flip_policy(pol):
-        return np.asarray([pol[ind] for ind in Config.unflipped_index])
+        """
+        :param pol: one policy or a (N, n_labels) batch of them
+        """
+        return np.asarray(pol)[..., Config.unflipped_index]
 
 
-Config.unflipped_index = [Config.labels.index(x) for x in Config.flipped_labels]
+_label_index = {x: i for i, x in enumerate(Config.labels)}
+Config.unflipped_index = np.asarray([_label_index[x] for x in Config.flipped_labels])
+Config.label_moves = [uci_to_move(x) for x in Config.labels]
+Config.move_lookup = np.full(MOVE_SPACE, -1, dtype=np.intp)
+Config.move_lookup[Config.label_moves] = np.arange(Config.n_labels)
 
 
 # print(Config.labels)
@@ -35,6 +35,10 @@ class PlayConfig:
         self.dirichlet_alpha = 0.3
         self.tau_decay_rate = 0.99
         self.virtual_loss = 3
+        self.search_batch_size = 0 # > 0: one thread evaluates this many leaves per request instead of search_threads
+        self.max_tree_nodes = 100000 # nodes (about 2KB each) kept between moves, None for no limit
+        self.eval_cache_size = 100000 # network evaluations kept per process (a few hundred bytes each), 0 to disable
+        self.shared_eval_cache_slots = 1 << 16 # slots (284 bytes each) of the table shared by the self-play processes, 0 to disable
         self.resign_threshold = -0.8
         self.min_resign_turn = 5
         self.max_game_length = 50 # before 1000
@@ -64,3 +68,9 @@ class ModelConfig:
     value_fc_size = 256
     distributed = False
     input_depth = 14
+    predict_batch_size = 16 # the inference thread runs a batch once this many states wait,
+    predict_max_latency = 0.002 # or the oldest request waited this long (seconds)
+    predict_batch_buckets = [1, 2, 4, 8, 16, 32] # batches are zero padded to one of these sizes
+    backend = "keras" # runs the predictions: keras, frozen, numpy or onnx (see agent/backend_chess.py)
+    backend_dtype = "fp32" # weights of the numpy and onnx backends: fp32, fp16 or int8
+    backend_exported = False # numpy and onnx load the file cmd export wrote for backend_dtype, not the keras weights
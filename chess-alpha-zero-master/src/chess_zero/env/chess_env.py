@@ -3,7 +3,6 @@ import enum
 from chess_zero.cchess.chessboard import Chessboard
 from chess_zero.cchess.common import *
 import numpy as np
-import copy
 
 from logging import getLogger
 
@@ -18,6 +17,19 @@ pieces_order = 'KABNRCPkabnrcp' # 14x10x9
 
 ind = {pieces_order[i]: i for i in range(14)}
 
+# lookup tables over board codes (see chess_zero.cchess.common), applied with numpy fancy indexing.
+# the canonical board is the board flipped for black, so that the side to move is always red (lower case)
+SWAPCASE = np.arange(256, dtype=np.uint8)
+SWAPCASE[ord('a'):ord('z') + 1] -= 32
+SWAPCASE[ord('A'):ord('Z') + 1] += 32
+PLANE_OF = np.full(256, len(pieces_order), dtype=np.int8) # plane of each code, 14 for an empty square
+for _ch in pieces_order:
+    PLANE_OF[ord(_ch)] = ind[_ch]
+PLANES = np.arange(len(pieces_order), dtype=np.int8).reshape(-1, 1, 1)
+# str.translate table turning the board part of a FEN into one code per square
+FEN_EXPAND = {ord(str(n)): chr(EMPTY) * n for n in range(1, 10)}
+FEN_EXPAND[ord('/')] = None
+
 
 class ChessEnv:
 
@@ -54,9 +66,9 @@ class ChessEnv:
     def white_to_move(self):
         return self.board.turn == RED
 
-    def step(self, action: str, check_over = True):
+    def step(self, action: int, check_over = True):
         """
-        :param action:
+        :param action: int move, see chess_zero.cchess.common.make_move
         :param check_over:
         :return:
         """
@@ -64,13 +76,23 @@ class ChessEnv:
             self._resign()
             return
 
-        self.board.push_uci(action)
+        self.board.push(action)
 
         self.num_halfmoves += 1
 
         if check_over and self.board.result(claim_draw=True) != "*":
             self._game_over()
 
+    def pop(self):
+        """
+        undo the last step, the search walks back up the tree with this instead of copying the env
+        """
+        self.board.pop()
+        self.num_halfmoves -= 1
+        self.winner = None
+        self.resigned = False
+        self.result = None
+
     def _game_over(self):
         if self.winner is None:
             self.result = self.board.result(claim_draw=True)
@@ -107,8 +129,12 @@ class ChessEnv:
         self.result = "1/2-1/2"
 
     def copy(self):
-        env = copy.deepcopy(self)
-        env.board = copy.deepcopy(self.board)
+        env = ChessEnv()
+        env.board = Chessboard(self.board)
+        env.num_halfmoves = self.num_halfmoves
+        env.winner = self.winner
+        env.resigned = self.resigned
+        env.result = self.result
         return env
 
     def render(self):
@@ -134,7 +160,7 @@ class ChessEnv:
         return replace_tags_board(self.board.fen())
 
     def canonical_input_planes(self):
-        return canon_input_planes(self.board.fen())
+        return codes_to_planes(canonical_codes(self.board))
 
     def testeval(self, absolute=False) -> float:
         return testeval(self.board.fen(), absolute)
@@ -200,19 +226,71 @@ def check_current_planes(realfen, planes):
 
 
 def canon_input_planes(fen):
-    fen = maybe_flip_fen(fen)
-    return all_input_planes(fen)
-
-
-def all_input_planes(fen):
-    # current_aux_planes = aux_planes(fen)
-
-    history_both = to_planes(fen)
-
-    # ret = np.vstack((history_both, current_aux_planes))
-    ret = history_both
-    assert ret.shape == (14, 10, 9)
-    return ret
+    return codes_to_planes(canonical_codes(Chessboard(fen)))
+
+
+def fens_to_planes(fens, out=None):
+    """
+    canonical input planes of N FENs, vectorized over the whole batch
+    :return: (N, 14, 10, 9) float32 planes and the (N,) bool mask of the black to move positions
+    """
+    boards = []
+    black = np.empty(len(fens), dtype=bool)
+    for i, fen in enumerate(fens):
+        board, turn = fen.split(' ', 2)[:2]
+        boards.append(board)
+        black[i] = turn == 'b'
+    board_str = "".join(boards).translate(FEN_EXPAND)
+    if len(board_str) != 90 * len(fens):
+        raise ValueError('malformed FEN in batch')
+    codes = np.frombuffer(board_str.encode('latin-1'), dtype=np.uint8).reshape(-1, 10, 9)
+    if black.any():
+        codes = canonicalize(codes.copy(), black)
+    return codes_to_planes(codes, out), black
+
+
+def canonicalize(codes, black):
+    """
+    turn the (N, 10, 9) codes of boards into those of the canonical boards, in place
+    :param black: (N,) bool mask of the black to move boards, those are flipped
+    """
+    if black.any():
+        codes[black] = SWAPCASE[codes[black][:, ::-1]]
+    return codes
+
+
+def canonical_codes(board: Chessboard) -> np.ndarray:
+    """
+    :return: (10, 9) uint8 codes of the canonical board, a read only view of the board when red is to move
+    """
+    codes = np.frombuffer(board.board, dtype=np.uint8).reshape(10, 9)
+    if board.turn == BLACK:
+        return SWAPCASE[codes[::-1]]
+    return codes
+
+
+def codes_to_planes(codes, out=None):
+    """
+    one hot encode canonical board codes, in one numpy call
+    :param codes: (10, 9) or (N, 10, 9) uint8 codes
+    :param out: optional float32 buffer of shape (14, 10, 9) or (N, 14, 10, 9) to write into
+    :return: the input planes
+    """
+    codes = np.asarray(codes)
+    if out is None:
+        out = np.empty(codes.shape[:-2] + (len(pieces_order), 10, 9), dtype=np.float32)
+    np.equal(PLANE_OF[codes][..., np.newaxis, :, :], PLANES, out=out, casting='unsafe')
+    return out
+
+
+def boards_to_planes(boards, out=None):
+    """
+    canonical input planes of N boards, written into out when it is given (e.g. a preallocated batch buffer)
+    """
+    codes = np.empty((len(boards), 10, 9), dtype=np.uint8)
+    for i, board in enumerate(boards):
+        codes[i] = canonical_codes(board)
+    return codes_to_planes(codes, out)
 
 
 def maybe_flip_fen(fen):
@@ -234,17 +312,14 @@ def maybe_flip_fen(fen):
         + " " + foo[3] + " " + foo[4] + " " + foo[5]
 
 
-def flip_move(mov:str) -> str:
-    return mov[0]+str(ord('9')-ord(mov[1]))+mov[2]+str(ord('9')-ord(mov[3]))
+def flip_move(mov: int) -> int:
+    return FLIPPED_MOVE[mov]
 
 
 def maybe_flip_moves(moves, flip=False):
     if not flip:
         return moves
-    rst = []
-    for mov in moves:
-        rst.append(flip_move(mov))
-    return rst
+    return [FLIPPED_MOVE[mov] for mov in moves]
 
 # def aux_planes(fen):
 #     foo = fen.split(' ')
@@ -301,18 +376,6 @@ def coord_to_alg(coord):
     return letter + number
 
 
-def to_planes(fen):
-    board_state = replace_tags_board(fen)
-    pieces_both = np.zeros(shape=(14, 10, 9), dtype=np.float32)
-    for rank in range(10):
-        for file in range(9):
-            v = board_state[rank * 9 + file]
-            if v.isalpha():
-                pieces_both[ind[v]][rank][file] = 1
-    assert pieces_both.shape == (14, 10, 9)
-    return pieces_both
-
-
 def replace_tags_board(board_san):
     board_san = board_san.split(" ")[0]
     board_san = board_san.replace("2", "11")
@@ -4,8 +4,11 @@ from datetime import datetime
 from glob import glob
 from logging import getLogger
 
-import pyperclip
-from chess_zero.config import ResourceConfig
+import numpy as np
+
+from chess_zero.config import Config, ResourceConfig
+from chess_zero.env.chess_env import codes_to_planes
+from chess_zero.lib.shard import read_shard, write_shard
 
 logger = getLogger(__name__)
 
@@ -39,18 +42,57 @@ def get_next_generation_model_dirs(rc: ResourceConfig):
     return dirs
 
 
-def write_game_data_to_file(path, data):
+def get_json_game_data_filenames(rc: ResourceConfig):
+    """play data files of the json format, see worker.convert"""
+    pattern = os.path.join(rc.play_data_dir, rc.play_data_json_filename_tmpl % "*")
+    return list(sorted(glob(pattern)))
+
+
+def write_game_data_to_file(path, games):
+    """
+    :param games: GameRecords, see lib.shard
+    """
     try:
-        with open(path, "wt") as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(e)
+        write_shard(path, games)
+    except (OSError, ValueError) as e:
+        logger.error("could not write play data to %s: %s" % (path, e))
 
 
 def read_game_data_from_file(path):
+    """
+    :return: the GameRecords of the shard at path, None if it can not be read
+    """
     try:
-        with open(path, "rt") as f:
-            return json.load(f)
-    except Exception as e:
+        return list(read_shard(path))
+    except (OSError, ValueError) as e:
+        logger.warning("could not read play data from %s: %s" % (path, e))
         return None
 
+
+def read_json_game_data_from_file(path):
+    with open(path, "rt") as f:
+        return json.load(f)
+
+
+def dense_policies(policies, rows):
+    """
+    :return: (len(rows), n_labels) float32 policies of the positions rows of the sparse policies
+    """
+    indptr, labels, probs = policies
+    counts = indptr[rows + 1] - indptr[rows]
+    out_rows = np.repeat(np.arange(len(rows)), counts)
+    entries = np.arange(counts.sum()) + np.repeat(indptr[rows] - (np.cumsum(counts) - counts), counts)
+    policy_ary = np.zeros((len(rows), Config.n_labels), dtype=np.float32)
+    policy_ary[out_rows, labels[entries]] = probs[entries]
+    return policy_ary
+
+
+def batch_generator(codes, policies, value_ary, num_train, batch_size):
+    """
+    batches of the first num_train positions for fit_generator, shuffled every epoch, forever
+    """
+    while True:
+        order = np.random.permutation(num_train)
+        for i in range(0, num_train, batch_size):
+            rows = order[i:i + batch_size]
+            yield codes_to_planes(codes[rows]), [dense_policies(policies, rows), value_ary[rows]]
@@ -0,0 +1,202 @@
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from chess_zero.lib.shm import SharedMemory, attach
+
+_process_cache = None
+_shared_cache = None
+
+
+class EvalCache:
+    """
+    LRU cache of network evaluations, keyed by (canonical position hash, model digest).
+    A policy is stored masked to the legal moves of its position (see VisitStats.expand), not over all labels,
+    so an entry is a few hundred bytes. Entries of a replaced model are never hit again, keep_models drops them.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.digests = set() # of the models with entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock() # the threaded search looks up from several threads
+
+    def get(self, key):
+        """
+        :return: (prior over the legal moves, value), or None
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, prior, value):
+        with self.lock:
+            self.entries[key] = (prior, value)
+            self.entries.move_to_end(key)
+            self.digests.add(key[1])
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def keep_models(self, digests):
+        """drop the entries of every model but those of digests"""
+        with self.lock:
+            if self.digests <= set(digests):
+                return
+            self.entries = OrderedDict((key, entry) for key, entry in self.entries.items() if key[1] in digests)
+            self.digests &= set(digests)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "%d/%d entries, %d hits, %d misses (%.1f%% hit rate)" % (
+            len(self.entries), self.max_size, self.hits, self.misses, 100 * self.hits / max(lookups, 1))
+
+
+def get_eval_cache(max_size):
+    """
+    :return: the cache of this process, shared by its players and kept across games. None when max_size is 0
+    """
+    global _process_cache
+    if not max_size:
+        return None
+    if _process_cache is None or _process_cache.max_size != max_size:
+        _process_cache = EvalCache(max_size)
+    return _process_cache
+
+
+def keep_models(*digests):
+    """
+    drop the evaluations of other models than those of digests from the cache of this process. The search
+    processes call it as a game starts, so the models replaced since their last game go away
+    """
+    if _process_cache is not None:
+        _process_cache.keep_models(digests)
+
+
+# a slot of the shared table. crc is the crc32 of the rest of the slot, a slot whose crc does not match
+# (never written, or read while another process writes it) is a miss, so no lock is needed.
+MAX_SHARED_PRIOR = 128 # positions with more legal moves are not shared
+SLOT_DTYPE = np.dtype([('crc', '<u4'), ('n', '<u2'), ('generation', '<u2'), ('value', '<f4'), ('key', '<u8'),
+                       ('tag', '<u8'), ('prior', '<f2', (MAX_SHARED_PRIOR,))])
+# hits, misses and stores of all processes as uint64, updated without a lock so roughly, then the generation
+HEADER_SIZE = 64
+
+
+class SharedEvalCache:
+    """
+    fixed size table of network evaluations in shared memory, read and written by every self-play process.
+    A position goes to slot key % num_slots and replaces what was there. The slot holds the model tag
+    (first 64 bits of the digest), the generation of the table it was written in, the value and the prior
+    over the legal moves as float16. The owner starts a new generation when the model changes (see
+    new_generation), from then on every process misses the slots written before.
+    """
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        self.num_slots = (shm.size - HEADER_SIZE) // SLOT_DTYPE.itemsize
+        self.counters = np.ndarray((4,), dtype=np.uint64, buffer=shm.buf)
+        self.slots = np.ndarray((self.num_slots,), dtype=SLOT_DTYPE, buffer=shm.buf, offset=HEADER_SIZE)
+        self.tags = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def create(cls, num_slots):
+        shm = SharedMemory(create=True, size=HEADER_SIZE + num_slots * SLOT_DTYPE.itemsize)
+        shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(attach(name), owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def generation(self):
+        return int(self.counters[3]) & 0xffff
+
+    def new_generation(self):
+        """make every slot written so far a miss, called by the owner when the model changes"""
+        self.counters[3] += 1
+
+    def tag(self, digest):
+        tag = self.tags.get(digest)
+        if tag is None:
+            tag = self.tags[digest] = int(digest[:16], 16)
+        return tag
+
+    def get(self, key, num_moves):
+        """
+        :param key: (state, model digest)
+        :param num_moves: number of legal moves of the state, a slot with another count is a hash collision
+        :return: (prior over the legal moves, value), or None
+        """
+        state, digest = key
+        slot = np.frombuffer(self.slots[state % self.num_slots].tobytes(), dtype=SLOT_DTYPE)[0]
+        if slot['key'] != state or slot['tag'] != self.tag(digest) or slot['n'] != num_moves or \
+                slot['generation'] != self.generation or slot['crc'] != zlib.crc32(slot.tobytes()[4:]):
+            self.misses += 1
+            self.counters[1] += 1
+            return None
+        self.hits += 1
+        self.counters[0] += 1
+        return slot['prior'][:num_moves].astype(np.float32), float(slot['value'])
+
+    def put(self, key, prior, value):
+        if len(prior) > MAX_SHARED_PRIOR:
+            return
+        state, digest = key
+        slot = np.zeros((), dtype=SLOT_DTYPE)
+        slot['n'] = len(prior)
+        slot['value'] = value
+        slot['key'] = state
+        slot['tag'] = self.tag(digest)
+        slot['generation'] = self.generation
+        slot['prior'][:len(prior)] = prior / np.sum(prior) # normalized so small priors survive float16
+        slot['crc'] = zlib.crc32(slot.tobytes()[4:])
+        self.slots[state % self.num_slots] = slot
+        self.counters[2] += 1
+
+    def stats(self):
+        hits, misses, stores = (int(x) for x in self.counters[:3])
+        return "%d slots, generation %d, this process %d hits %d misses, " \
+               "all processes %.1f%% hit rate (%d hits, %d stores)" % (
+                   self.num_slots, self.generation, self.hits, self.misses, 100 * hits / max(hits + misses, 1),
+                   hits, stores)
+
+    def close(self):
+        self.counters = self.slots = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def create_shared_cache(num_slots):
+    """
+    :return: a new shared table for the worker processes to attach to by name, or None when disabled
+    """
+    if not num_slots:
+        return None
+    return SharedEvalCache.create(num_slots)
+
+
+def attach_shared_cache(name):
+    """
+    :return: the shared table of this process, attached once and kept across games. None when name is None
+    """
+    global _shared_cache
+    if name is None:
+        return None
+    if _shared_cache is None or _shared_cache.name != name:
+        _shared_cache = SharedEvalCache.attach(name)
+    return _shared_cache
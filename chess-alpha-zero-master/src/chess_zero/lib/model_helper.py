@@ -1,8 +1,90 @@
+import hashlib
+import json
+import os
 from logging import getLogger
 
 logger = getLogger(__name__)
 
 
+def new_model(config):
+    """
+    :return: a ChessModel, or with --server a RemoteChessModel whose network lives in the inference server,
+        or with ModelConfig.backend_exported an ExportedChessModel running the file of cmd export
+    """
+    if config.opts.server:
+        from chess_zero.agent.remote_chess import RemoteChessModel
+        return RemoteChessModel(config)
+    if config.model.backend_exported:
+        from chess_zero.agent.exported_chess import ExportedChessModel
+        return ExportedChessModel(config)
+    from chess_zero.agent.model_chess import ChessModel
+    return ChessModel(config)
+
+
+DIGEST_CHUNK = 1 << 20
+
+
+def fetch_digest(weight_path):
+    """
+    :return: the digest from the manifest of weight_path while it describes the file, else the file is hashed
+    """
+    if os.path.exists(weight_path):
+        manifest = read_manifest(weight_path)
+        if manifest is None:
+            return file_digest(weight_path)
+        return manifest['digest']
+
+
+def file_digest(weight_path):
+    m = hashlib.sha256()
+    with open(weight_path, "rb") as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK), b""):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def manifest_path(weight_path):
+    return os.path.splitext(weight_path)[0] + "_manifest.json"
+
+
+def read_manifest(weight_path, check=True):
+    """
+    :param check: only return the manifest if the size and mtime of weight_path are still the ones in it
+    :return: {'digest', 'size', 'mtime_ns', 'generation'} or None
+    """
+    try:
+        with open(manifest_path(weight_path), "rt") as f:
+            manifest = json.load(f)
+        if check:
+            stat = os.stat(weight_path)
+            if manifest['size'] != stat.st_size or manifest['mtime_ns'] != stat.st_mtime_ns:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+
+def write_manifest(weight_path, digest=None, generation=None):
+    """
+    hash the weights just saved to weight_path and write their manifest next to them. The manifest is replaced
+    atomically, readers see the old or the new one
+    :param digest: of the weights when known already
+    :param generation: defaults to one more than the one of the manifest before
+    :return: the manifest
+    """
+    if generation is None:
+        generation = (read_manifest(weight_path, check=False) or {}).get('generation', 0) + 1
+    stat = os.stat(weight_path)
+    manifest = dict(digest=digest or file_digest(weight_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                    generation=generation)
+    path = manifest_path(weight_path)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wt") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+    return manifest
+
+
 def load_best_model_weight(model):
     """
     :param chess_zero.agent.model.ChessModel model:
@@ -26,13 +108,22 @@ def need_to_reload_best_model_weight(model):
     :param chess_zero.agent.model.ChessModel model:
     :return:
     """
+    logger.debug("start reload the best model if changed")
     if model.config.model.distributed:
-        return load_best_model_weight(model)
+        from chess_zero.lib.model_store import STORE_ERRORS, open_store
+        try:
+            with open_store(model.config) as store:
+                manifest = store.fetch_manifest()
+        except STORE_ERRORS as e:
+            logger.warning("could not reach the model store: %s" % e)
+            return False
+        if manifest is None: # nothing pushed yet
+            return False
+        digest = manifest['digest']
     else:
-        logger.debug("start reload the best model if changed")
         digest = model.fetch_digest(model.config.resource.model_best_weight_path)
-        if digest != model.digest:
-            return True
+    if digest != model.digest:
+        return True
 
-        logger.debug("the best model is not changed")
-        return False
+    logger.debug("the best model is not changed")
+    return False
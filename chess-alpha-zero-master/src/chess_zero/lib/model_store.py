@@ -0,0 +1,241 @@
+"""
+content addressed store of models, where distributed mode pulls the best model from and pushes it to.
+A weight file is cut into chunks, each kept as a blob named by its digest (blobs/<sha256>), and a model
+is a manifest listing them (refs/<name>.json), written last. Pushing sends only the chunks the store
+lacks and pulling fetches only those the local weight file lacks, so a new generation costs the chunks
+that changed. The store is reached through a transport: a directory (LocalTransport) or a store server,
+cmd store, on another machine (SocketTransport).
+"""
+import hashlib
+import json
+import os
+import re
+from logging import getLogger
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+from chess_zero.lib.model_helper import fetch_digest, file_digest, write_manifest
+
+logger = getLogger(__name__)
+
+CHUNK_SIZE = 1 << 18
+BEST = 'model_best'
+NAME = re.compile(r'(blobs/[0-9a-f]{64}|refs/[\w.-]+\.json)$')
+ADDRESS = re.compile(r'([\w.-]+):(\d+)$')
+# what pushing and pulling raise when the store cannot be reached or holds something broken
+STORE_ERRORS = (OSError, EOFError, AuthenticationError, RuntimeError)
+
+
+def check_name(name):
+    if not NAME.match(name):
+        raise ValueError("not a name in the model store: %r" % name)
+    return name
+
+
+def parse_address(address):
+    """:return: (host, port) of 'host:port'"""
+    host, port = ADDRESS.match(address).groups()
+    return host, int(port)
+
+
+def create_transport(config):
+    """
+    :return: a SocketTransport when config.resource.model_store is host:port, else a LocalTransport of that directory
+    """
+    rc = config.resource
+    if ADDRESS.match(rc.model_store):
+        return SocketTransport(parse_address(rc.model_store), rc.model_store_key)
+    return LocalTransport(rc.model_store)
+
+
+def open_store(config):
+    return ModelStore(create_transport(config))
+
+
+class LocalTransport:
+    """the store in a directory of this machine (or of a shared file system)"""
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        return os.path.join(self.root, check_name(name))
+
+    def read(self, name):
+        """:return: the bytes stored under name, None if there are none"""
+        try:
+            with open(self.path(name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def missing(self, names):
+        """:return: those of names not in the store"""
+        return [name for name in names if not os.path.exists(self.path(name))]
+
+    def close(self):
+        pass
+
+
+class SocketTransport:
+    """
+    the store served by cmd store (see worker.store). A request is a json header, {'op': 'read' | 'write' | 'missing',
+    'name' or 'names'}, followed by the data for a write. A read is answered with b'\\x01' and the data, or b'\\x00'.
+    """
+    def __init__(self, address, authkey=None):
+        self.address = address
+        self.authkey = authkey.encode() if authkey else None
+        self.conn = None
+
+    def call(self, header, data=None):
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=self.authkey)
+        self.conn.send_bytes(json.dumps(header).encode())
+        if data is not None:
+            self.conn.send_bytes(data)
+        return self.conn.recv_bytes()
+
+    def read(self, name):
+        reply = self.call(dict(op='read', name=name))
+        return reply[1:] if reply[:1] == b'\x01' else None
+
+    def write(self, name, data):
+        self.call(dict(op='write', name=name), data)
+
+    def missing(self, names):
+        return json.loads(self.call(dict(op='missing', names=names)).decode())
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def serve_request(transport, conn):
+    """answer one request of a SocketTransport on conn from transport"""
+    header = json.loads(conn.recv_bytes().decode())
+    op = header['op']
+    if op == 'read':
+        data = transport.read(header['name'])
+        conn.send_bytes(b'\x00' if data is None else b'\x01' + data)
+    elif op == 'write':
+        transport.write(header['name'], conn.recv_bytes())
+        conn.send_bytes(b'')
+    elif op == 'missing':
+        conn.send_bytes(json.dumps(transport.missing(header['names'])).encode())
+    else:
+        raise ValueError("unknown request %s" % op)
+
+
+def read_chunks(path, chunk_size):
+    """:return: [(digest, chunk)] of the file at path"""
+    chunks = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            chunks.append((hashlib.sha256(chunk).hexdigest(), chunk))
+    return chunks
+
+
+class ModelStore:
+    """
+    :ivar transport: LocalTransport or SocketTransport
+    """
+    def __init__(self, transport, chunk_size=CHUNK_SIZE):
+        self.transport = transport
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.transport.close()
+
+    def fetch_manifest(self, name=BEST):
+        """
+        :return: {'digest', 'size', 'generation', 'chunk_size', 'chunks', 'config'} of the model stored as name,
+            None if there is none
+        """
+        data = self.transport.read('refs/%s.json' % name)
+        return json.loads(data.decode()) if data is not None else None
+
+    def push(self, config_path, weight_path, name=BEST):
+        """
+        store the model saved in config_path and weight_path as name
+        :return: its manifest
+        """
+        chunks = read_chunks(weight_path, self.chunk_size)
+        with open(config_path, "rb") as f:
+            config_data = f.read()
+        blobs = dict(chunks)
+        config_digest = hashlib.sha256(config_data).hexdigest()
+        blobs[config_digest] = config_data
+        missing = self.transport.missing(['blobs/' + digest for digest in blobs])
+        for blob in missing:
+            self.transport.write(blob, blobs[blob[len('blobs/'):]])
+
+        old = self.fetch_manifest(name) or {}
+        manifest = dict(digest=fetch_digest(weight_path), size=os.path.getsize(weight_path),
+                        generation=old.get('generation', 0) + 1, chunk_size=self.chunk_size,
+                        chunks=[digest for digest, _ in chunks], config=config_digest)
+        self.transport.write('refs/%s.json' % name, json.dumps(manifest).encode())
+        logger.info("pushed %s generation %d, %d of %d blobs were new (%.1f MB)" % (
+            name, manifest['generation'], len(missing), len(blobs),
+            sum(len(blobs[blob[len('blobs/'):]]) for blob in missing) / 1e6))
+        return manifest
+
+    def pull(self, config_path, weight_path, name=BEST):
+        """
+        write the model stored as name to config_path and weight_path, reusing the chunks weight_path has already
+        :return: its manifest, None if there is none
+        """
+        manifest = self.fetch_manifest(name)
+        if manifest is None:
+            return None
+        if not os.path.exists(config_path) or file_digest(config_path) != manifest['config']:
+            replace(config_path, [self.read_blob(manifest['config'])])
+        if fetch_digest(weight_path) == manifest['digest']:
+            return manifest
+
+        local = dict(read_chunks(weight_path, manifest['chunk_size'])) if os.path.exists(weight_path) else {}
+        num_fetched = 0
+        chunks = []
+        for digest in manifest['chunks']:
+            chunk = local.get(digest)
+            if chunk is None:
+                chunk = local[digest] = self.read_blob(digest)
+                num_fetched += 1
+            chunks.append(chunk)
+        replace(weight_path, chunks, manifest['digest'])
+        write_manifest(weight_path, digest=manifest['digest'], generation=manifest['generation'])
+        logger.info("pulled %s generation %d, fetched %d of %d chunks" % (
+            name, manifest['generation'], num_fetched, len(manifest['chunks'])))
+        return manifest
+
+    def read_blob(self, digest):
+        data = self.transport.read('blobs/' + digest)
+        if data is None:
+            raise RuntimeError("blob %s is missing from the model store" % digest)
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RuntimeError("blob %s in the model store is corrupt" % digest)
+        return data
+
+
+def replace(path, chunks, digest=None):
+    """write chunks to path atomically, checking that their digest is digest"""
+    m = hashlib.sha256()
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        for chunk in chunks:
+            m.update(chunk)
+            f.write(chunk)
+    if digest is not None and m.hexdigest() != digest:
+        os.remove(tmp_path)
+        raise RuntimeError("%s does not have the digest of its manifest" % path)
+    os.replace(tmp_path, path)
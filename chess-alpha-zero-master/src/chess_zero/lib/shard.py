@@ -0,0 +1,234 @@
+"""
+binary play data shards. A shard holds games, each as its start FEN, the labels of the moves played, the policy
+target of every position as sparse (labels, probabilities) and the result, so a position costs its visited
+moves and two bytes instead of a FEN and n_labels floats. Positions are rebuilt by replaying the moves.
+
+layout, little endian:
+    header  b'CCZS', uint16 version
+    game    uint16 FEN length, int8 result for red (1, 0, -1), uint16 moves, uint16 positions,
+            the FEN, uint16 move labels[moves], uint8 entries[positions],
+            uint16 labels[sum(entries)], float32 probabilities[sum(entries)]
+
+position i of a game is its start position after moves[:i]. Labels are those of Config.labels, the policies
+are not flipped for black (like ChessPlayer.calc_policy returns them).
+"""
+import os
+import struct
+
+import numpy as np
+
+from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.cchess.common import BLACK
+from chess_zero.config import Config
+from chess_zero.env.chess_env import canonicalize
+
+MAGIC = b'CCZS'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+GAME = struct.Struct('<HbHH')
+
+
+class GameRecord:
+    """
+    one game of a shard. Built position by position with add, or read with all the entries in one array
+    """
+    def __init__(self, start_fen, result, moves=None, counts=None, labels=None, probs=None):
+        """
+        :param result: 1 if red won, -1 if black won, 0 for a draw
+        """
+        self.start_fen = start_fen
+        self.result = result
+        self.moves = [] if moves is None else moves
+        self.counts = [] if counts is None else counts # entries of each position
+        self.labels = [] if labels is None else labels # arrays of entries
+        self.probs = [] if probs is None else probs
+
+    @staticmethod
+    def from_play(data, actions):
+        """
+        :param data: the positions of one game in the format of ChessPlayer.moves, [fen, (labels, policy), value]
+        :param actions: the int moves played from them
+        :return: the game, None if it has no position
+        """
+        if not data:
+            return None
+        fen, _, value = data[0]
+        game = GameRecord(fen, int(value if is_red_turn(fen) else -value))
+        for (_, (labels, policy), _), action in zip(data, actions):
+            game.add(labels, policy, Config.move_lookup[action])
+        return game
+
+    def add(self, labels, policy, move=None):
+        """
+        :param labels: labels of the policy entries of the next position
+        :param policy: their probabilities
+        :param move: label of the move played from it, None if unknown (the last one of a converted game)
+        """
+        labels = np.asarray(labels)
+        if len(labels) and (labels.min() < 0 or labels.max() >= Config.n_labels):
+            raise ValueError("policy labels out of range: %s" % labels)
+        if move is not None and not 0 <= move < Config.n_labels:
+            raise ValueError("move without a label: %s" % move)
+        self.labels.append(labels.astype(np.uint16))
+        self.probs.append(np.asarray(policy, dtype=np.float32))
+        self.counts.append(len(labels))
+        if move is not None:
+            self.moves.append(int(move))
+
+    def __len__(self):
+        return len(self.counts)
+
+
+def is_red_turn(fen):
+    return fen.split(' ', 2)[1] != 'b'
+
+
+def concat(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype, copy=False) if len(arrays) else np.empty(0, dtype=dtype)
+
+
+class ShardWriter:
+    """writes games to a shard as they come, the shard appears at path when the writer is closed"""
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        self.f = open(self.tmp_path, "wb")
+        self.f.write(HEADER.pack(MAGIC, VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp_path)
+
+    def write(self, game: GameRecord):
+        fen = game.start_fen.encode('ascii')
+        counts = np.asarray(game.counts)
+        if counts.size and counts.max() > 255:
+            raise ValueError("a position with %d policy entries does not fit a shard" % counts.max())
+        self.f.write(GAME.pack(len(fen), game.result, len(game.moves), len(counts)))
+        self.f.write(fen)
+        self.f.write(np.asarray(game.moves, dtype='<u2').tobytes())
+        self.f.write(counts.astype(np.uint8).tobytes())
+        self.f.write(concat(game.labels, '<u2').tobytes())
+        self.f.write(concat(game.probs, '<f4').tobytes())
+
+    def close(self):
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def write_shard(path, games):
+    with ShardWriter(path) as writer:
+        for game in games:
+            writer.write(game)
+
+
+def read_exactly(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("truncated shard %s" % f.name)
+    return data
+
+
+def read_shard(path):
+    """
+    :return: generator of the GameRecords of the shard at path, read as they are needed
+    """
+    with open(path, "rb") as f:
+        magic, version = HEADER.unpack(read_exactly(f, HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("%s is not a play data shard" % path)
+        if version != VERSION:
+            raise ValueError("%s has shard version %d, this reads %d" % (path, version, VERSION))
+        while True:
+            head = f.read(GAME.size)
+            if not head:
+                return
+            if len(head) != GAME.size:
+                raise ValueError("truncated shard %s" % path)
+            fen_len, result, num_moves, num_positions = GAME.unpack(head)
+            fen = read_exactly(f, fen_len).decode('ascii')
+            moves = np.frombuffer(read_exactly(f, 2 * num_moves), dtype='<u2')
+            counts = np.frombuffer(read_exactly(f, num_positions), dtype=np.uint8)
+            num_entries = int(counts.sum(dtype=np.int64))
+            labels = np.frombuffer(read_exactly(f, 2 * num_entries), dtype='<u2')
+            probs = np.frombuffer(read_exactly(f, 4 * num_entries), dtype='<f4')
+            yield GameRecord(fen, result, moves, counts, [labels], [probs])
+
+
+def game_arrays(games):
+    """
+    the positions of games for training, seen from the side to move (boards flipped and labels mapped for black)
+    :return: (N, 10, 9) canonical codes, (N,) values, and the sparse policies: (N + 1,) offsets of the entries
+        of each position, their labels and probabilities
+    """
+    num_positions = sum(len(game) for game in games)
+    codes = np.empty((num_positions, 90), dtype=np.uint8)
+    black = np.empty(num_positions, dtype=bool)
+    values = np.empty(num_positions, dtype=np.float32)
+    k = 0
+    for game in games:
+        board = Chessboard(game.start_fen)
+        for i in range(len(game)):
+            if i:
+                board.push(Config.label_moves[game.moves[i - 1]])
+            codes[k] = board.board
+            black[k] = board.turn == BLACK
+            values[k] = -game.result if black[k] else game.result
+            k += 1
+    counts = concat([np.asarray(game.counts) for game in games], np.intp)
+    indptr = np.zeros(num_positions + 1, dtype=np.intp)
+    np.cumsum(counts, out=indptr[1:])
+    labels = concat([x for game in games for x in game.labels], np.int16)
+    probs = concat([x for game in games for x in game.probs], np.float32)
+    flip = np.repeat(black, counts)
+    labels[flip] = Config.unflipped_index[labels[flip]]
+    return canonicalize(codes.reshape(-1, 10, 9), black), values, indptr, labels, probs
+
+
+def games_from_positions(data):
+    """
+    the games of a json play data file: a list of [fen, policy, value] positions of consecutive games. A position
+    continues the game before it when a legal move leads to it and the result agrees, the move played from the
+    last position of a game is lost
+    """
+    games = []
+    game = board = None
+    prev_labels = None
+    for fen, policy, value in data:
+        result = int(value if is_red_turn(fen) else -value)
+        move = None
+        if game is not None and result == game.result:
+            move = find_move(board, fen, prev_labels)
+        if move is None:
+            game = GameRecord(fen, result)
+            games.append(game)
+            board = Chessboard(fen)
+        else:
+            game.moves.append(int(Config.move_lookup[move]))
+            board.push(move)
+        policy = np.asarray(policy, dtype=np.float32)
+        labels = np.flatnonzero(policy)
+        game.add(labels, policy[labels])
+        prev_labels = labels
+    return games
+
+
+def find_move(board, fen, labels):
+    """:return: the legal move of board that leads to fen, trying the moves of labels first, or None"""
+    legal = board.legal_moves
+    candidates = [Config.label_moves[x] for x in labels]
+    for move in candidates + legal:
+        if move not in legal:
+            continue
+        board.push(move)
+        found = board.fen() == fen
+        board.pop()
+        if found:
+            return move
+    return None
@@ -0,0 +1,59 @@
+"""
+named shared memory for python 3.6+: multiprocessing.shared_memory where it exists (3.8+),
+otherwise a file in /dev/shm mapped by every process that opens it by name.
+"""
+import mmap
+import os
+import secrets
+import tempfile
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class MappedFile:
+    def __init__(self, name=None, create=False, size=0):
+        if name is None:
+            name = 'psm_' + secrets.token_hex(8)
+        self._name = name
+        self._path = os.path.join(SHM_DIR, name)
+        if create:
+            fd = os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+            os.ftruncate(fd, size)
+        else:
+            fd = os.open(self._path, os.O_RDWR)
+            size = os.fstat(fd).st_size
+        try:
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        self.buf = memoryview(self._mmap)
+
+    @property
+    def name(self):
+        return self._name
+
+    def close(self):
+        self.buf.release()
+        self._mmap.close()
+
+    def unlink(self):
+        os.unlink(self._path)
+
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:
+    SHM_DIR = SHM_DIR or tempfile.gettempdir()
+    SharedMemory = MappedFile
+
+
+def attach(name):
+    """
+    open a segment another process created. Where segments are files in /dev/shm the file is mapped directly,
+    which keeps it out of the resource tracker of this process (the stdlib class registers every segment it
+    opens, so a client exiting would unlink the segments of the process that serves it)
+    """
+    if SHM_DIR is None:
+        return SharedMemory(name=name)
+    return MappedFile(name=name)
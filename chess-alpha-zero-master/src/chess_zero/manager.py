@@ -7,7 +7,7 @@ from .config import Config
 
 logger = getLogger(__name__)
 
-CMD_LIST = ['self', 'opt', 'eval', 'sl', 'uci']
+CMD_LIST = ['self', 'opt', 'eval', 'sl', 'uci', 'bench', 'serve', 'export', 'store', 'convert']
 
 
 def create_parser():
@@ -16,6 +16,11 @@ def create_parser():
     parser.add_argument("--new", help="run from new best model", action="store_true")
     parser.add_argument("--type", help="use normal setting", default="mini")
     parser.add_argument("--total-step", help="set TrainerConfig.start_total_steps", type=int)
+    parser.add_argument("--suite", help="comma separated benchmark suites for cmd bench", default="all")
+    parser.add_argument("--depth", help="perft depth for cmd bench", type=int, default=3)
+    parser.add_argument("--server", help="self, eval and uci use the network of a running serve", action="store_true")
+    parser.add_argument("--format", help="file format for cmd export: npz or onnx", default="npz")
+    parser.add_argument("--dtype", help="weight type for cmd export: fp32, fp16 or int8", default="fp16")
     return parser
 
 
@@ -23,6 +28,11 @@ def setup(config: Config, args):
     config.opts.new = args.new
     if args.total_step is not None:
         config.trainer.start_total_steps = args.total_step
+    config.opts.bench_suite = args.suite
+    config.opts.bench_depth = args.depth
+    config.opts.server = args.server
+    config.opts.export_format = args.format
+    config.opts.export_dtype = args.dtype
     config.resource.create_directories()
     setup_logger(config.resource.main_log_path)
 
@@ -55,3 +65,18 @@ def start():
     elif args.cmd == 'uci':
         from .play_game import uci
         return uci.start(config)
+    elif args.cmd == 'bench':
+        from .worker import benchmark
+        return benchmark.start(config)
+    elif args.cmd == 'serve':
+        from .worker import serve
+        return serve.start(config)
+    elif args.cmd == 'export':
+        from .worker import export
+        return export.start(config)
+    elif args.cmd == 'store':
+        from .worker import store
+        return store.start(config)
+    elif args.cmd == 'convert':
+        from .worker import convert
+        return convert.start(config)
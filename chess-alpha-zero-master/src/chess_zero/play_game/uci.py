@@ -1,9 +1,10 @@
 import sys
 from logging import getLogger
 
-from chess_zero.agent.player_chess import ChessPlayer
+from chess_zero.agent.player_chess import ChessPlayer, search_pipes
 from chess_zero.config import Config, PlayWithHumanConfig
 from chess_zero.env.chess_env import ChessEnv
+from chess_zero.cchess.common import uci_to_move, move_to_uci
 
 logger = getLogger(__name__)
 
@@ -44,25 +45,25 @@ def start(config: Config):
                 words = words[1].split(" ",1)
                 if words[0] == "moves":
                     for w in words[1].split(" "):
-                        env.step(w, False)
+                        env.step(uci_to_move(w), False)
         elif words[0] == "go":
             if not me_player:
                 me_player = get_player(config)
             action = me_player.action(env, False)
-            print(f"bestmove {action}")
+            print(f"bestmove {move_to_uci(action)}")
         elif words[0] == "stop":
             pass
         elif words[0] == "quit":
             break
+        sys.stdout.flush() # GUIs talk through a pipe, where print is block buffered
 
 
 def get_player(config):
-    from chess_zero.agent.model_chess import ChessModel
-    from chess_zero.lib.model_helper import load_best_model_weight
-    model = ChessModel(config)
+    from chess_zero.lib.model_helper import load_best_model_weight, new_model
+    model = new_model(config)
     if not load_best_model_weight(model):
         raise RuntimeError("Best model not found!")
-    return ChessPlayer(config, model.get_pipes(config.play.search_threads))
+    return ChessPlayer(config, pipes=search_pipes(model, config.play), model_digest=model.digest)
 
 
 def info(depth, move, score):
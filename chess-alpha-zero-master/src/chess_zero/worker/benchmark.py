@@ -0,0 +1,334 @@
+import os
+import random
+import subprocess
+import sys
+from logging import getLogger
+from time import time
+
+import numpy as np
+
+from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.cchess.perft import REFERENCE_POSITIONS, perft, divide
+from chess_zero.config import Config
+from chess_zero.env.chess_env import ChessEnv, boards_to_planes, fens_to_planes
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    suites = config.opts.bench_suite.split(',')
+    if 'all' in suites:
+        suites = list(SUITES)
+    ok = True
+    for name in suites:
+        if name not in SUITES:
+            raise RuntimeError('unknown benchmark suite: %s (choose from %s)' % (name, ', '.join(SUITES)))
+        print('=== %s' % name)
+        ok = SUITES[name](config) is not False and ok
+    return ok
+
+
+def bench_perft(config: Config):
+    """perft of the reference positions, with divide output for the first wrong count"""
+    depth = config.opts.bench_depth
+    ok = True
+    for name, fen, counts in REFERENCE_POSITIONS:
+        board = Chessboard(fen)
+        for d in range(1, min(depth, len(counts)) + 1):
+            start_time = time()
+            nodes = perft(board, d)
+            elapsed = time() - start_time
+            status = 'ok' if nodes == counts[d-1] else 'FAIL (expected %d)' % counts[d-1]
+            print('%-14s depth %d: %10d nodes %7.2fs %9.0f nps  %s' % (name, d, nodes, elapsed, nodes / max(elapsed, 1e-9), status))
+            if nodes != counts[d-1]:
+                ok = False
+                for mov, n in divide(board, d):
+                    print('  %s: %d' % (mov, n))
+                break
+    return ok
+
+
+def sample_positions(num=1000, seed=0):
+    """FENs along random games from the start position, reproducible through the seed"""
+    rnd = random.Random(seed)
+    fens = []
+    board = Chessboard()
+    while len(fens) < num:
+        moves = board.legal_moves
+        if not moves or board.steps >= 200:
+            board = Chessboard()
+            continue
+        fens.append(board.fen())
+        board.push(rnd.choice(moves))
+    return fens
+
+
+def bench_movegen(config: Config):
+    """calls per second of legal_moves, push (+pop) and fen() on their own, over a fixed set of positions"""
+    boards = [Chessboard(fen) for fen in sample_positions()]
+
+    start_time = time()
+    for board in boards:
+        board.legal_moves # computed once per fresh board
+    report('legal_moves', len(boards), time() - start_time)
+
+    num = 0
+    start_time = time()
+    for board in boards:
+        for mov in board.legal_moves:
+            board.push(mov)
+            board.pop()
+        num += len(board.legal_moves)
+    report('push+pop', num, time() - start_time)
+
+    start_time = time()
+    for board in boards:
+        board._fen = None # drop the cache so fen() is rebuilt from the board
+        board.fen()
+    report('fen', len(boards), time() - start_time)
+
+
+def bench_planes(config: Config, batch_size=64):
+    """input planes per second, one board at a time and in batches written into a preallocated buffer"""
+    envs = [ChessEnv().update(fen) for fen in sample_positions()]
+
+    start_time = time()
+    for env in envs:
+        env.canonical_input_planes()
+    report('planes', len(envs), time() - start_time)
+
+    boards = [env.board for env in envs]
+    out = np.empty((batch_size, 14, 10, 9), dtype=np.float32)
+    start_time = time()
+    for i in range(0, len(boards) - batch_size + 1, batch_size):
+        boards_to_planes(boards[i:i + batch_size], out)
+    report('batch planes', len(boards) // batch_size * batch_size, time() - start_time)
+
+
+def sample_play_data(config: Config, num=2000, seed=0):
+    """
+    random games from the start position as self-play records them: per game the [fen, (labels, policy), value]
+    positions and the moves played, with a random policy over the legal moves
+    """
+    rnd = np.random.RandomState(seed)
+    games = []
+    num_positions = 0
+    while num_positions < num:
+        board = Chessboard()
+        data, actions = [], []
+        while board.legal_moves and board.steps < 200 and num_positions < num:
+            moves = board.legal_moves
+            policy = rnd.dirichlet([0.3] * len(moves)).astype(np.float32)
+            data.append([board.fen(), (config.move_lookup[moves].astype(np.uint16), policy)])
+            actions.append(moves[rnd.randint(len(moves))])
+            board.push(actions[-1])
+            num_positions += 1
+        result = float(rnd.choice([-1, 0, 1]))
+        for position in data:
+            position.append(result if position[0].split(' ')[1] == 'r' else -result)
+        games.append((data, actions))
+    return games
+
+
+def bench_decode(config: Config):
+    """
+    play data files: size, write time and load time (read and decoded into training arrays) of a file of
+    positions, as the shards of lib.shard and as the json files before them
+    """
+    import json
+    import tempfile
+    from chess_zero.lib.shard import GameRecord, read_shard, write_shard
+    from chess_zero.lib.data_helper import batch_generator
+    from chess_zero.worker.optimize import convert_to_cheating_data
+    games = sample_play_data(config)
+    data = []
+    for game_data, _ in games:
+        for fen, (labels, probs), value in game_data:
+            policy = np.zeros(config.n_labels)
+            policy[labels] = probs
+            data.append([fen, policy.tolist(), value])
+    records = [GameRecord.from_play(game_data, actions) for game_data, actions in games]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path, shard_path = os.path.join(tmp_dir, 'play.json'), os.path.join(tmp_dir, 'play.shard')
+        start_time = time()
+        with open(json_path, 'wt') as f:
+            json.dump(data, f)
+        report('json write', len(data), time() - start_time)
+        start_time = time()
+        with open(json_path, 'rt') as f:
+            fens, policies, values = zip(*json.load(f))
+        state_ary, black = fens_to_planes(fens)
+        policy_ary = np.asarray(policies, dtype=np.float32)
+        policy_ary[black] = Config.flip_policy(policy_ary[black])
+        report('json load', len(data), time() - start_time)
+
+        start_time = time()
+        write_shard(shard_path, records)
+        report('shard write', len(data), time() - start_time)
+        start_time = time()
+        codes, policies, value_ary = convert_to_cheating_data(list(read_shard(shard_path)))
+        report('shard load', len(data), time() - start_time)
+        start_time = time()
+        batches = batch_generator(codes, policies, value_ary, len(codes), config.trainer.batch_size)
+        for _ in range(-(-len(codes) // config.trainer.batch_size)):
+            next(batches)
+        report('shard batches', len(data), time() - start_time)
+        print('bytes per position: json %.0f, shard %.1f' % (
+            os.path.getsize(json_path) / len(data), os.path.getsize(shard_path) / len(data)))
+        print('bytes per loaded position: dense %.0f, sparse %.1f' % (
+            (state_ary.nbytes + policy_ary.nbytes) / len(data) + 4,
+            (codes.nbytes + value_ary.nbytes + sum(x.nbytes for x in policies)) / len(data)))
+
+
+class UniformPipe:
+    """stands in for a model pipe: a uniform policy and a value of 0, so the search is timed on its own"""
+    digest = None
+
+    def __init__(self, n_labels):
+        self.policy = np.full(n_labels, 1 / n_labels, dtype=np.float32)
+
+    def predict(self, planes):
+        if planes.ndim == 4:
+            return np.tile(self.policy, (len(planes), 1)), np.zeros(len(planes), dtype=np.float32)
+        return self.policy, 0.0
+
+    def predict_boards(self, codes, labels=None):
+        if labels is not None:
+            if codes.ndim == 3:
+                return [np.full(len(x), 1 / len(x), dtype=np.float32) for x in labels], \
+                       np.zeros(len(codes), dtype=np.float32)
+            return np.full(len(labels), 1 / len(labels), dtype=np.float32), 0.0
+        if codes.ndim == 3:
+            return np.tile(self.policy, (len(codes), 1)), np.zeros(len(codes), dtype=np.float32)
+        return self.policy, 0.0
+
+
+def bench_mcts(config: Config, num_moves=4):
+    """simulations per second of ChessPlayer.search_moves with PlayConfig settings, without a network"""
+    from chess_zero.agent.player_chess import ChessPlayer
+    pipes = [UniformPipe(config.n_labels) for _ in range(config.play.search_threads)]
+    player = ChessPlayer(config, pipes=pipes)
+    env = ChessEnv().reset()
+    num = 0
+    start_time = time()
+    for _ in range(num_moves):
+        player.search_moves(env)
+        num += config.play.simulation_num_per_move
+        env.step(env.board.legal_moves[0])
+    report('simulations', num, time() - start_time)
+
+
+def bench_backends(config: Config, repeat=5):
+    """
+    milliseconds per batch of every inference backend and weight type for the batch sizes of
+    predict_batch_buckets, and how far their policies and values drift from float32 numpy (or keras when
+    it loads the best model): largest absolute difference and agreement of the top policy move
+    """
+    from chess_zero.agent import backend_chess as backends
+    rc = config.resource
+    if os.path.exists(rc.model_best_weight_path):
+        weights = backends.fold_weights(backends.read_keras_weights(rc.model_best_weight_path))
+    else:
+        print('no best model, random weights of the model config')
+        weights = backends.random_weights(config)
+
+    candidates = []
+    try:
+        from chess_zero.agent.model_chess import ChessModel
+        from chess_zero.lib.model_helper import load_best_model_weight
+        model = ChessModel(config)
+        if load_best_model_weight(model):
+            candidates += [('keras', 'fp32', model.model), ('frozen', 'fp32', backends.FrozenGraphBackend(model.model))]
+    except ImportError as e:
+        print('skipping keras: %s' % e)
+    for dtype in backends.DTYPES:
+        candidates.append(('numpy', dtype, backends.NumpyBackend(backends.quantized(weights, dtype))))
+    try:
+        for dtype in backends.DTYPES:
+            model = backends.onnx_model(weights, dtype).SerializeToString()
+            candidates.append(('onnx', dtype, backends.OnnxBackend(model)))
+    except ImportError as e:
+        print('skipping onnx: %s' % e)
+
+    buckets = config.model.predict_batch_buckets
+    planes = fens_to_planes(sample_positions(max(buckets)))[0]
+    ref_policy, ref_value = candidates[0][2].predict_on_batch(planes)
+    print('ms per batch of')
+    print('%-14s %s %s' % ('backend', ' '.join('%8d' % n for n in buckets), '  policy diff  value diff  top1 agree'))
+    for name, dtype, backend in candidates:
+        times = []
+        for n in buckets:
+            backend.predict_on_batch(planes[:n]) # warm up
+            best = None
+            for _ in range(repeat):
+                start_time = time()
+                backend.predict_on_batch(planes[:n])
+                best = min(best or 1e9, time() - start_time)
+            times.append(best)
+        policy, value = backend.predict_on_batch(planes)
+        agree = np.mean(np.argmax(policy, axis=1) == np.argmax(ref_policy, axis=1))
+        print('%-14s %s %13.2e %11.2e %10.1f%%' % (
+            '%s %s' % (name, dtype), ' '.join('%8.2f' % (t * 1000) for t in times),
+            np.max(np.abs(policy - ref_policy)), np.max(np.abs(value - ref_value)), 100 * agree))
+
+
+# the module each command runs, see manager.start
+COMMAND_MODULES = [
+    ('self', 'chess_zero.worker.self_play'),
+    ('opt', 'chess_zero.worker.optimize'),
+    ('eval', 'chess_zero.worker.evaluate'),
+    ('sl', 'chess_zero.worker.sl'),
+    ('uci', 'chess_zero.play_game.uci'),
+    ('serve', 'chess_zero.worker.serve'),
+    ('bench', 'chess_zero.worker.benchmark'),
+]
+
+
+def bench_startup(config: Config, repeat=3):
+    """
+    seconds a fresh interpreter takes to import the module of each command (best of repeat),
+    and for uci the time from starting run.py to the uciok answer
+    """
+    src_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([src_dir, os.environ.get('PYTHONPATH', '')]))
+    for cmd, module in COMMAND_MODULES:
+        best = None
+        for _ in range(repeat):
+            start_time = time()
+            ret = subprocess.run([sys.executable, '-c', 'import ' + module], env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if ret.returncode != 0:
+                break
+            best = min(best or 1e9, time() - start_time)
+        print('%-14s %s' % ('import ' + cmd, 'failed' if best is None else '%7.3fs' % best))
+
+    best = None
+    for _ in range(repeat):
+        start_time = time()
+        proc = subprocess.Popen([sys.executable, os.path.join(src_dir, 'chess_zero', 'run.py'), 'uci'], env=env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True)
+        proc.stdin.write('uci\n')
+        proc.stdin.flush()
+        for line in proc.stdout:
+            if line.strip() == 'uciok':
+                best = min(best or 1e9, time() - start_time)
+                break
+        proc.communicate('quit\n')
+    print('%-14s %s' % ('uci to uciok', 'failed' if best is None else '%7.3fs' % best))
+
+
+def report(name, num, elapsed):
+    print('%-14s %8d calls %7.3fs %10.0f per second' % (name, num, elapsed, num / max(elapsed, 1e-9)))
+
+
+SUITES = {
+    'perft': bench_perft,
+    'movegen': bench_movegen,
+    'planes': bench_planes,
+    'decode': bench_decode,
+    'mcts': bench_mcts,
+    'startup': bench_startup,
+    'backends': bench_backends,
+}
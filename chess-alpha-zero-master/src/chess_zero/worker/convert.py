@@ -0,0 +1,58 @@
+import os
+from logging import getLogger
+
+import numpy as np
+
+from chess_zero.config import Config
+from chess_zero.env.chess_env import codes_to_planes, fens_to_planes
+from chess_zero.lib.data_helper import get_json_game_data_filenames, read_json_game_data_from_file
+from chess_zero.lib.shard import game_arrays, games_from_positions, read_shard, write_shard
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    return convert_play_data(config)
+
+
+def convert_play_data(config: Config):
+    """
+    turn the json play data files into shards (see lib.shard). A json file is removed once its shard reads back
+    the same training positions
+    """
+    rc = config.resource
+    ok = True
+    for path in get_json_game_data_filenames(rc):
+        try:
+            data = read_json_game_data_from_file(path)
+        except (OSError, ValueError) as e:
+            logger.warning("could not read %s: %s" % (path, e))
+            ok = False
+            continue
+        shard_path = os.path.splitext(path)[0] + os.path.splitext(rc.play_data_filename_tmpl)[1]
+        games = games_from_positions(data)
+        write_shard(shard_path, games)
+        if not same_positions(data, list(read_shard(shard_path))):
+            logger.error("%s does not read back as %s, keeping both" % (shard_path, path))
+            ok = False
+            continue
+        logger.info("converted %s: %d positions of %d games, %.1f KB -> %.1f KB" % (
+            path, len(data), len(games), os.path.getsize(path) / 1e3, os.path.getsize(shard_path) / 1e3))
+        os.remove(path)
+    return ok
+
+
+def same_positions(data, games):
+    """:return: whether games hold the training positions of the json data, as optimize decodes them"""
+    codes, values, indptr, labels, probs = game_arrays(games)
+    if len(codes) != len(data):
+        return False
+    rows = np.repeat(np.arange(len(codes)), np.diff(indptr))
+    fens, policies, json_values = zip(*data) if data else ((), (), ())
+    planes, black = fens_to_planes(fens)
+    policy_ary = np.asarray(policies, dtype=np.float32).reshape(len(data), Config.n_labels)
+    policy_ary[black] = Config.flip_policy(policy_ary[black])
+    shard_policy = np.zeros_like(policy_ary)
+    shard_policy[rows, labels] = probs
+    return np.array_equal(codes_to_planes(codes), planes) and np.array_equal(values, np.float32(json_values)) \
+        and np.array_equal(shard_policy, policy_ary)
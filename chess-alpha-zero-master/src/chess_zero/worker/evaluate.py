@@ -1,16 +1,15 @@
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import as_completed
 from logging import getLogger
 from multiprocessing import Manager
 from time import sleep
 from collections import deque
 
-from chess_zero.agent.model_chess import ChessModel
-from chess_zero.agent.player_chess import ChessPlayer
+from chess_zero.agent.player_chess import search_pipes
 from chess_zero.config import Config
-from chess_zero.env.chess_env import ChessEnv, Winner
 from chess_zero.lib.data_helper import get_next_generation_model_dirs
-from chess_zero.lib.model_helper import save_as_best_model, load_best_model_weight
+from chess_zero.lib.model_helper import save_as_best_model, load_best_model_weight, new_model
+from chess_zero.worker.search_worker import search_executor, play_game
 import time
 
 logger = getLogger(__name__)
@@ -27,10 +26,10 @@ class EvaluateWorker:
         self.config = config
         self.play_config = config.eval.play_config
         self.current_model = self.load_current_model()
-        self.ng_model = ChessModel(self.config)
+        self.ng_model = new_model(self.config)
         self.m = Manager()
-        self.cur_pipes = self.m.list([self.current_model.get_pipes(self.play_config.search_threads) for _ in range(self.play_config.max_processes)])
-        self.ng_pipes = self.m.list([self.ng_model.get_pipes(self.play_config.search_threads) for _ in range(self.play_config.max_processes)])
+        self.cur_pipes = self.m.list([search_pipes(self.current_model, self.play_config) for _ in range(self.play_config.max_processes)])
+        self.ng_pipes = self.m.list([search_pipes(self.ng_model, self.play_config) for _ in range(self.play_config.max_processes)])
         self.model_list = []
         self.history_list = []
 
@@ -50,9 +49,10 @@ class EvaluateWorker:
     def evaluate_model(self):
 
         futures = deque()
-        with ProcessPoolExecutor(max_workers=self.play_config.max_processes) as executor:
+        with search_executor(self.config, self.play_config.max_processes) as executor:
             for game_idx in range(self.config.eval.game_num):
-                fut = executor.submit(play_game, self.config, cur=self.cur_pipes, ng=self.ng_pipes, current_white=(game_idx % 2 == 0))
+                fut = executor.submit(play_game, self.config, cur=self.cur_pipes, ng=self.ng_pipes, current_white=(game_idx % 2 == 0),
+                                      cur_digest=self.current_model.digest, ng_digest=self.ng_model.digest)
                 futures.append(fut)
 
             results = []
@@ -100,7 +100,7 @@ class EvaluateWorker:
         os.rename(model_dir, new_dir)
 
     def load_current_model(self):
-        model = ChessModel(self.config)
+        model = new_model(self.config)
         load_best_model_weight(model)
         return model
 
@@ -133,35 +133,3 @@ class EvaluateWorker:
         weight_path = os.path.join(model_dir, rc.next_generation_model_weight_filename)
         self.ng_model.load(config_path, weight_path)
         return model_dir, config_path, weight_path
-
-
-def play_game(config, cur, ng, current_white: bool) -> (float, ChessEnv, bool):
-    cur_pipes = cur.pop()
-    ng_pipes = ng.pop()
-    env = ChessEnv().reset()
-
-    current_player = ChessPlayer(config, pipes=cur_pipes, play_config=config.eval.play_config)
-    ng_player = ChessPlayer(config, pipes=ng_pipes, play_config=config.eval.play_config)
-    if current_white:
-        white, black = current_player, ng_player
-    else:
-        white, black = ng_player, current_player
-
-    while not env.done:
-        if env.white_to_move:
-            action = white.action(env)
-        else:
-            action = black.action(env)
-        env.step(action)
-        if env.num_halfmoves >= config.eval.max_game_length:
-            env.adjudicate()
-
-    if env.winner == Winner.draw:
-        ng_score = 0.5
-    elif env.white_won == current_white:
-        ng_score = 0
-    else:
-        ng_score = 1
-    cur.append(cur_pipes)
-    ng.append(ng_pipes)
-    return ng_score, env, current_white
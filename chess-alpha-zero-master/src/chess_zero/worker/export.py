@@ -0,0 +1,29 @@
+import os
+from logging import getLogger
+
+from chess_zero.agent.backend_chess import export_weights, export_onnx, exported_path
+from chess_zero.config import Config
+from chess_zero.lib.model_helper import write_manifest
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    """
+    write the best model for the inference backends next to its weight file, as
+    model_best_weight.<dtype>.<format> (see agent/backend_chess.py). The numpy and onnx backends load
+    the npz and onnx files with ModelConfig.backend_exported
+    """
+    rc = config.resource
+    fmt, dtype = config.opts.export_format, config.opts.export_dtype
+    out_path = exported_path(rc.model_best_weight_path, dtype, fmt)
+    if fmt == 'npz':
+        export_weights(rc.model_best_weight_path, out_path, dtype)
+    elif fmt == 'onnx':
+        export_onnx(rc.model_best_weight_path, out_path, dtype)
+    else:
+        raise RuntimeError('unknown export format: %s (choose from npz, onnx)' % fmt)
+    write_manifest(out_path) # the digest a model loading it checks for a new generation
+    logger.info("exported %s (%d bytes, weight file %d bytes)" % (
+        out_path, os.path.getsize(out_path), os.path.getsize(rc.model_best_weight_path)))
+
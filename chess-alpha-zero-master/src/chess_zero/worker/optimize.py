@@ -10,9 +10,11 @@ import numpy as np
 
 from chess_zero.agent.model_chess import ChessModel
 from chess_zero.config import Config
-from chess_zero.env.chess_env import canon_input_planes, is_black_turn, testeval
-from chess_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, get_next_generation_model_dirs
+from chess_zero.env.chess_env import codes_to_planes
+from chess_zero.lib.data_helper import get_game_data_filenames, read_game_data_from_file, get_next_generation_model_dirs, \
+    batch_generator, dense_policies
 from chess_zero.lib.model_helper import load_best_model_weight
+from chess_zero.lib.shard import game_arrays
 
 from keras.optimizers import Adam
 from keras.callbacks import TensorBoard
@@ -30,7 +32,8 @@ class OptimizeWorker:
         self.model = None  # type: ChessModel
         self.loaded_filenames = set()
         self.loaded_data = deque(maxlen=self.config.trainer.dataset_size) # this should just be a ring buffer i.e. queue of length 500,000 in AZ
-        self.dataset = deque(),deque(),deque()
+        self.dataset = [] # (codes, sparse policies, values) of the loaded files, see convert_to_cheating_data
+        self.num_positions = 0
         self.executor = ProcessPoolExecutor(max_workers=config.trainer.cleaning_processes)
         self.filenames = []
 
@@ -62,26 +65,32 @@ class OptimizeWorker:
                 self.filenames = deque(files)
                 shuffle(self.filenames)
                 self.fill_queue()
-                if len(self.dataset[0]) > self.config.trainer.batch_size:
+                if self.num_positions > self.config.trainer.batch_size:
                     steps = self.train_epoch(self.config.trainer.epoch_to_checkpoint)
                     total_steps += steps
                     self.save_current_model()
-                    a, b, c = self.dataset
-                    a.clear()
-                    b.clear()
-                    c.clear()
+                    self.dataset = []
+                    self.num_positions = 0
 
     def train_epoch(self, epochs):
+        """
+        the positions stay board codes and sparse policies, the planes and dense policies are built per batch.
+        The last 2% are held out for validation, like validation_split did
+        """
         tc = self.config.trainer
-        state_ary, policy_ary, value_ary = self.collect_all_loaded_data()
+        codes, policies, value_ary = self.collect_all_loaded_data()
+        num_train = len(codes) - int(len(codes) * 0.02)
+        validation_data = None
+        if num_train < len(codes):
+            rows = np.arange(num_train, len(codes))
+            validation_data = (codes_to_planes(codes[rows]), [dense_policies(policies, rows), value_ary[rows]])
         tensorboard_cb = TensorBoard(log_dir="./logs", batch_size=tc.batch_size, histogram_freq=1)
-        self.model.model.fit(state_ary, [policy_ary, value_ary],
-                             batch_size=tc.batch_size,
-                             epochs=epochs,
-                             shuffle=True,
-                             validation_split=0.02,
-                             callbacks=[tensorboard_cb])
-        steps = (state_ary.shape[0] // tc.batch_size) * epochs
+        self.model.model.fit_generator(batch_generator(codes, policies, value_ary, num_train, tc.batch_size),
+                                       steps_per_epoch=-(-num_train // tc.batch_size),
+                                       epochs=epochs,
+                                       validation_data=validation_data,
+                                       callbacks=[tensorboard_cb])
+        steps = (codes.shape[0] // tc.batch_size) * epochs
         return steps
 
     def compile_model(self):
@@ -107,23 +116,28 @@ class OptimizeWorker:
                 filename = self.filenames.pop()
                 logger.debug("loading data from %s" % (filename))
                 futures.append(executor.submit(load_data_from_file,filename))
-            while futures and len(self.dataset[0]) < self.config.trainer.dataset_size: #fill tuples
+            while futures and self.num_positions < self.config.trainer.dataset_size: #fill tuples
                 tuple = futures.popleft().result()
                 if tuple is not None:
-                    for x,y in zip(self.dataset,tuple):
-                        x.extend(y)
+                    self.dataset.append(tuple)
+                    self.num_positions += len(tuple[0])
                 if len(self.filenames) > 0:
                     filename = self.filenames.pop()
                     logger.debug("loading data from %s" % (filename))
                     futures.append(executor.submit(load_data_from_file,filename))
 
     def collect_all_loaded_data(self):
-        state_ary,policy_ary,value_ary=self.dataset
-
-        state_ary1 = np.asarray(state_ary, dtype=np.float32)
-        policy_ary1 = np.asarray(policy_ary, dtype=np.float32)
-        value_ary1 = np.asarray(value_ary, dtype=np.float32)
-        return state_ary1, policy_ary1, value_ary1
+        """
+        :return: the loaded files joined, in the format of convert_to_cheating_data
+        """
+        codes = np.concatenate([x[0] for x in self.dataset])
+        indptr = [np.zeros(1, dtype=np.intp)]
+        for _, (file_indptr, _, _), _ in self.dataset:
+            indptr.append(file_indptr[1:] + indptr[-1][-1])
+        labels = np.concatenate([x[1][1] for x in self.dataset])
+        probs = np.concatenate([x[1][2] for x in self.dataset])
+        value_ary = np.concatenate([x[2] for x in self.dataset])
+        return codes, (np.concatenate(indptr), labels, probs), value_ary
 
     def load_model(self):
         model = ChessModel(self.config)
@@ -150,28 +164,14 @@ def load_data_from_file(filename):
     return convert_to_cheating_data(data)
 
 
-def convert_to_cheating_data(data):
+def convert_to_cheating_data(games):
     """
-    :param data: format is SelfPlayWorker.buffer
-    :return:
+    decode a whole file at once: the positions of all games are replayed into canonical board codes, and the
+    policies kept sparse, as they are in the shard. A position takes about 300 bytes instead of the 13 KB
+    of its planes and dense policy, those are built per batch (see batch_generator)
+    :param games: GameRecords of a play data file, see lib.shard
+    :return: (N, 10, 9) codes, policies as (indptr, labels, probs) (those of position i are
+        labels[indptr[i]:indptr[i + 1]]) and (N,) values
     """
-    state_list = []
-    policy_list = []
-    value_list = []
-    for state_fen, policy, value in data:
-
-        state_planes = canon_input_planes(state_fen)
-
-        if is_black_turn(state_fen):
-            policy = Config.flip_policy(policy)
-
-        move_number = int(state_fen.split(' ')[5])
-        value_certainty = min(5, move_number)/5 # reduces the noise of the opening... plz train faster
-        # sl_value = value*value_certainty + testeval(state_fen, False)*(1-value_certainty)
-        sl_value = value
-
-        state_list.append(state_planes)
-        policy_list.append(policy)
-        value_list.append(sl_value)
-
-    return np.asarray(state_list, dtype=np.float32), np.asarray(policy_list, dtype=np.float32), np.asarray(value_list, dtype=np.float32)
+    codes, value_ary, indptr, labels, probs = game_arrays(games)
+    return codes, (indptr, labels, probs), value_ary
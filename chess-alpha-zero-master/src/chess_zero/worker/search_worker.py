@@ -0,0 +1,133 @@
+"""
+what the self-play and evaluation processes run. They reach the network only through pipes (see SlotPipe),
+so nothing imported from here may import tensorflow or keras, which keeps the processes small and quick
+to start. The pools come from search_executor.
+"""
+import sys
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger
+
+from chess_zero.agent.player_chess import ChessPlayer, SearchTree
+from chess_zero.config import Config
+from chess_zero.env.chess_env import ChessEnv, Winner
+from chess_zero.lib.eval_cache import attach_shared_cache, keep_models
+from chess_zero.lib.logger import setup_logger
+from chess_zero.lib.shard import GameRecord
+
+logger = getLogger(__name__)
+
+
+def search_executor(config: Config, max_workers):
+    """
+    :return: ProcessPoolExecutor for the search processes. Before python 3.7 it takes the default start method,
+        which run.py sets to spawn
+    """
+    if sys.version_info < (3, 7):
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context(),
+                               initializer=init_worker, initargs=(config,))
+
+
+def get_context():
+    """
+    :return: multiprocessing context for the search processes. Never fork, the parent may hold tensorflow:
+        forkserver where there is one (the processes fork from a server that imported this module only),
+        else spawn
+    """
+    if 'forkserver' in mp.get_all_start_methods():
+        ctx = mp.get_context('forkserver')
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return mp.get_context('spawn')
+
+
+def init_worker(config: Config):
+    """initializer of the search processes"""
+    setup_logger(config.resource.main_log_path)
+    if 'tensorflow' in sys.modules or 'keras' in sys.modules:
+        logger.warning("search process imported tensorflow")
+
+
+def self_play_buffer(config, cur, digest=None, shared_cache_name=None) -> (ChessEnv, GameRecord):
+    pipes = cur.pop() # borrow
+    env = ChessEnv().reset()
+    search_tree = SearchTree(config.play.max_tree_nodes)
+    shared_cache = attach_shared_cache(shared_cache_name)
+    keep_models(digest)
+
+    white = ChessPlayer(config, search_tree=search_tree, pipes=pipes, model_digest=digest, shared_cache=shared_cache)
+    black = ChessPlayer(config, search_tree=search_tree, pipes=pipes, model_digest=digest, shared_cache=shared_cache)
+
+    history = []
+
+    cc = 0
+    while not env.done:
+        if env.white_to_move:
+            action = white.action(env)
+        else:
+            action = black.action(env)
+        env.step(action)
+        history.append(action)
+        if len(history) > 6 and history[-1] == history[-5]:
+            cc = cc + 1
+        else:
+            cc = 0
+        if env.num_halfmoves >= config.play.max_game_length or cc >= 4:
+            env.adjudicate()
+    if env.winner == Winner.white:
+        black_win = -1
+    elif env.winner == Winner.black:
+        black_win = 1
+    else:
+        black_win = 0
+
+    black.finish_game(black_win)
+    white.finish_game(-black_win)
+    logger.debug("search tree at game end: %s" % search_tree.stats())
+    if white.eval_cache is not None:
+        logger.debug("eval cache at game end: %s" % white.eval_cache.stats())
+    if shared_cache is not None:
+        logger.debug("shared eval cache at game end: %s" % shared_cache.stats())
+
+    data = []
+    for i in range(len(white.moves)):
+        data.append(white.moves[i])
+        if i < len(black.moves):
+            data.append(black.moves[i])
+
+    cur.append(pipes)
+    return env, GameRecord.from_play(data, history)
+
+
+def play_game(config, cur, ng, current_white: bool, cur_digest=None, ng_digest=None) -> (float, ChessEnv, bool):
+    cur_pipes = cur.pop()
+    ng_pipes = ng.pop()
+    env = ChessEnv().reset()
+    keep_models(cur_digest, ng_digest)
+
+    current_player = ChessPlayer(config, pipes=cur_pipes, play_config=config.eval.play_config, model_digest=cur_digest)
+    ng_player = ChessPlayer(config, pipes=ng_pipes, play_config=config.eval.play_config, model_digest=ng_digest)
+    if current_white:
+        white, black = current_player, ng_player
+    else:
+        white, black = ng_player, current_player
+
+    while not env.done:
+        if env.white_to_move:
+            action = white.action(env)
+        else:
+            action = black.action(env)
+        env.step(action)
+        if env.num_halfmoves >= config.eval.max_game_length:
+            env.adjudicate()
+
+    if env.winner == Winner.draw:
+        ng_score = 0.5
+    elif env.white_won == current_white:
+        ng_score = 0
+    else:
+        ng_score = 1
+    cur.append(cur_pipes)
+    ng.append(ng_pipes)
+    return ng_score, env, current_white
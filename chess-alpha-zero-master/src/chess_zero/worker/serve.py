@@ -0,0 +1,208 @@
+import os
+import socket
+import struct
+from logging import getLogger
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+from threading import Lock, Thread
+
+from chess_zero.agent.api_chess import ChessModelAPI
+from chess_zero.agent.model_chess import ChessModel
+from chess_zero.config import Config
+from chess_zero.lib.model_helper import fetch_digest
+
+logger = getLogger(__name__)
+
+HANDSHAKE_TIMEOUT = 10 # seconds for each read and write of a new connection until it has said hello
+
+
+def start(config: Config):
+    return InferenceServer(config).serve_forever()
+
+
+class InferenceServer:
+    """
+    one process running the networks for self, eval and uci started with --server (see RemoteChessModel).
+    Networks are hosted by digest, so clients loading the same weights share one copy. Every client model
+    is a name bound to one of them, and the pipes of all names go through one ChessModelAPI, which batches
+    them together. A network is dropped when no name is bound to it anymore. A name loading new weights
+    while it is the only one bound to its network has them swapped into that network, between two batches.
+
+    The socket and a key made for each run are in ResourceConfig.inference_dir, which only this user can enter.
+    Connections that do not authenticate with the key are refused before anything is unpickled from them.
+    Each connection authenticates in its own thread, under HANDSHAKE_TIMEOUT, so a stalled one blocks nobody else.
+    A client connects on the unix socket and sends ('control',) or ('pipe', name, max_states) first.
+    A control connection gets its name and then sends requests (see handle), a pipe connection gets
+    the name of its shared memory slot and is served by the API from then on.
+    """
+    def __init__(self, config: Config):
+        self.config = config
+        self.api = ChessModelAPI(config)
+        self.networks = {} # digest (or ('build', name) until saved) -> ChessModel
+        self.bindings = {} # name -> key in networks
+        self.lock = Lock()
+        self.num_clients = 0
+
+    def serve_forever(self):
+        rc = self.config.resource
+        address = rc.inference_socket_path
+        make_private_dir(rc.inference_dir)
+        remove_stale_socket(address)
+        authkey = write_authkey(rc.inference_key_path)
+        self.api.start()
+        with Listener(address, family='AF_UNIX') as listener:
+            logger.info("inference server listening on %s" % address)
+            while True:
+                try:
+                    conn = listener.accept()
+                except OSError as e:
+                    logger.warning("accept failed: %r" % e)
+                    continue
+                Thread(target=self.welcome, args=(conn, authkey), daemon=True).start()
+
+    def welcome(self, conn, authkey):
+        """authenticate a new connection and serve it as its hello asks, off the accept thread"""
+        try:
+            set_timeout(conn, HANDSHAKE_TIMEOUT)
+            deliver_challenge(conn, authkey)
+            answer_challenge(conn, authkey)
+            hello = conn.recv()
+            set_timeout(conn, 0)
+        except (AuthenticationError, EOFError, OSError) as e:
+            logger.warning("refused a connection: %r" % e)
+            conn.close()
+            return
+        if hello[0] == 'control':
+            self.serve_control(conn)
+        elif hello[0] == 'pipe':
+            _, name, max_states = hello
+            shm_name = self.api.add_pipe(conn, max_states, key=name)
+            conn.send((shm_name, self.config.n_labels))
+        else:
+            logger.warning("unknown connection %r" % (hello,))
+            conn.close()
+
+    def serve_control(self, conn):
+        with self.lock:
+            self.num_clients += 1
+            name = 'model-%d' % self.num_clients
+        conn.send(name)
+        try:
+            while True:
+                request = conn.recv()
+                try:
+                    ret = self.handle(name, *request)
+                except Exception as e:
+                    logger.exception("%s failed" % (request,))
+                    ret = RuntimeError("inference server: %s" % e)
+                conn.send(ret)
+        except (EOFError, OSError):
+            pass
+        finally:
+            with self.lock:
+                self.bind(name, None)
+            conn.close()
+
+    def handle(self, name, cmd, *args):
+        """
+        :return: ('load', config_path, weight_path) and ('save', config_path, weight_path) return the digest
+            of the network bound to name (None when there was nothing to load), ('build',) binds a new
+            network and ('ping',) only makes sure the name exists
+        """
+        if cmd == 'ping':
+            return None
+        with self.lock:
+            if cmd == 'load':
+                return self.load(name, *args)
+            if cmd == 'build':
+                model = self.new_network()
+                model.build()
+                self.bind(name, ('build', name), model)
+                return None
+            if cmd == 'save':
+                model = self.api.models.get(name)
+                if model is None:
+                    raise RuntimeError("%s has no network to save" % name)
+                model.save(*args)
+                self.bind(name, model.digest, model)
+                return model.digest
+        raise ValueError("unknown request %s" % cmd)
+
+    def load(self, name, config_path, weight_path):
+        # the best model of distributed mode is fetched by ChessModel.load, so its file is not known yet
+        digest = None if self.config.model.distributed else fetch_digest(weight_path)
+        model = self.networks.get(digest)
+        if model is None:
+            model = self.own_network(name) or self.new_network()
+            if not model.load(config_path, weight_path):
+                return None
+        self.bind(name, model.digest, model)
+        return model.digest
+
+    def new_network(self):
+        model = ChessModel(self.config)
+        model.api = self.api
+        return model
+
+    def own_network(self, name):
+        """:return: the network bound to name if no other name is bound to it, else None"""
+        key = self.bindings.get(name)
+        if key is None or list(self.bindings.values()).count(key) > 1:
+            return None
+        return self.networks[key]
+
+    def bind(self, name, key, model=None):
+        """bind name to the network under key (None to unbind) and drop the networks left without a name"""
+        if key is None:
+            self.bindings.pop(name, None)
+            self.api.models.pop(name, None)
+        else:
+            model = self.networks.setdefault(key, model)
+            self.bindings[name] = key
+            self.api.models[name] = model
+        used = set(self.bindings.values())
+        for key in [key for key in self.networks if key not in used]:
+            del self.networks[key]
+            logger.info("dropped network %s" % (key,))
+        logger.info("%d networks, bindings {%s}" % (
+            len(self.networks), ", ".join("%s: %s" % (n, str(k)[:16]) for n, k in sorted(self.bindings.items()))))
+
+
+def make_private_dir(path):
+    """create the directory path, or take an existing one, with access for this user only"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+
+
+def write_authkey(key_path):
+    """:return: a new random key, written to key_path for the clients, readable by this user only"""
+    authkey = os.urandom(32)
+    tmp_path = "%s.%d.tmp" % (key_path, os.getpid())
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(authkey)
+    os.replace(tmp_path, key_path)
+    return authkey
+
+
+def set_timeout(conn, seconds):
+    """make blocking reads and writes on the socket of conn fail with an OSError after seconds, 0 for never"""
+    sock = socket.socket(fileno=os.dup(conn.fileno()))
+    try:
+        tv = struct.pack('ll', int(seconds), int(seconds % 1 * 1000000))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, tv)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, tv)
+    finally:
+        sock.close()
+
+
+def remove_stale_socket(address):
+    """remove the socket file a server left behind, unless that server still runs"""
+    if not os.path.exists(address):
+        return
+    try:
+        Client(address, family='AF_UNIX').close()
+    except ConnectionRefusedError:
+        os.remove(address)
+        return
+    raise RuntimeError("an inference server is already listening on %s" % address)
@@ -11,7 +11,9 @@ import chess.pgn
 from chess_zero.agent.player_chess import ChessPlayer
 from chess_zero.config import Config
 from chess_zero.env.chess_env import ChessEnv, Winner
+from chess_zero.cchess.common import uci_to_move
 from chess_zero.lib.data_helper import write_game_data_to_file, find_pgn_files
+from chess_zero.lib.shard import GameRecord
 
 logger = getLogger(__name__)
 
@@ -61,7 +63,8 @@ class SupervisedLearningWorker:
         return games
 
     def save_data(self, data):
-        self.buffer += data
+        if data is not None:
+            self.buffer.append(data)
         if self.idx % self.config.play_data.sl_nb_game_in_file == 0:
             self.flush_buffer()
 
@@ -92,7 +95,7 @@ def clip_elo_policy(config, elo):
     # 0 until min_elo, 1 after max_elo, linear in between
 
 
-def get_buffer(config, game) -> (ChessEnv, list):
+def get_buffer(config, game) -> (ChessEnv, GameRecord):
     env = ChessEnv().reset()
     white = ChessPlayer(config, dummy=True)
     black = ChessPlayer(config, dummy=True)
@@ -104,7 +107,11 @@ def get_buffer(config, game) -> (ChessEnv, list):
     actions = []
     while not game.is_end():
         game = game.variation(0)
-        actions.append(game.move.uci())
+        action = uci_to_move(game.move.uci())
+        if config.move_lookup[action] < 0: # no label, a shard could not replay the positions after it
+            logger.warning("game cut at %s, a move without a label" % game.move.uci())
+            break
+        actions.append(action)
     k = 0
     while not env.done and k < len(actions):
         if env.white_to_move:
@@ -135,4 +142,4 @@ def get_buffer(config, game) -> (ChessEnv, list):
         if i < len(black.moves):
             data.append(black.moves[i])
 
-    return env, data
\ No newline at end of file
+    return env, GameRecord.from_play(data, actions)
\ No newline at end of file
@@ -0,0 +1,55 @@
+from logging import getLogger
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from threading import Thread
+
+from chess_zero.config import Config
+from chess_zero.lib.model_store import LocalTransport, parse_address, serve_request
+
+logger = getLogger(__name__)
+
+
+def start(config: Config):
+    return StoreServer(config).serve_forever()
+
+
+class StoreServer:
+    """
+    serves the model store in config.resource.model_store_dir to the machines of distributed mode, whose
+    MODEL_STORE is the host:port it listens on (see lib.model_store.SocketTransport)
+    """
+    def __init__(self, config: Config):
+        self.config = config
+        self.transport = LocalTransport(config.resource.model_store_dir)
+
+    def serve_forever(self):
+        with self.listen() as listener:
+            self.serve(listener)
+
+    def listen(self):
+        """:return: Listener on model_store_listen, port 0 takes a free port (see its address)"""
+        rc = self.config.resource
+        authkey = rc.model_store_key.encode() if rc.model_store_key else None
+        listener = Listener(parse_address(rc.model_store_listen), authkey=authkey)
+        logger.info("model store %s listening on %s:%d" % (rc.model_store_dir, *listener.address))
+        return listener
+
+    def serve(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError) as e:
+                logger.warning("refused a client: %s" % e)
+                continue
+            Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+
+    def serve_client(self, conn):
+        try:
+            while True:
+                serve_request(self.transport, conn)
+        except (EOFError, OSError):
+            pass
+        except (ValueError, KeyError) as e:
+            logger.warning("bad request: %s" % e)
+        finally:
+            conn.close()
@@ -0,0 +1,97 @@
+import json
+import os
+from threading import Thread
+
+import pytest
+
+from chess_zero.config import Config
+from chess_zero.lib.model_helper import fetch_digest, file_digest
+from chess_zero.lib.model_store import LocalTransport, ModelStore, SocketTransport
+from chess_zero.worker.store import StoreServer
+
+CHUNK_SIZE = 1024
+NUM_CHUNKS = 8
+
+
+class CountingTransport:
+    """forwards to a transport and counts the blobs read and written through it"""
+    def __init__(self, transport):
+        self.transport = transport
+        self.reads = []
+        self.writes = []
+
+    def read(self, name):
+        if name.startswith('blobs/'):
+            self.reads.append(name)
+        return self.transport.read(name)
+
+    def write(self, name, data):
+        if name.startswith('blobs/'):
+            self.writes.append(name)
+        self.transport.write(name, data)
+
+    def missing(self, names):
+        return self.transport.missing(names)
+
+    def close(self):
+        self.transport.close()
+
+
+def write_model(model_dir, weights):
+    os.makedirs(model_dir, exist_ok=True)
+    config_path = os.path.join(model_dir, "model_best_config.json")
+    weight_path = os.path.join(model_dir, "model_best_weight.h5")
+    with open(config_path, "wt") as f:
+        json.dump({'name': 'chess_model'}, f)
+    with open(weight_path, "wb") as f:
+        f.write(weights)
+    return config_path, weight_path
+
+
+def push_then_pull_a_change(tmpdir, make_transport):
+    weights = bytearray(os.urandom(CHUNK_SIZE * NUM_CHUNKS))
+    config_path, weight_path = write_model(str(tmpdir.join("trainer")), bytes(weights))
+    pulled_config_path = str(tmpdir.join("player", "model_best_config.json"))
+    pulled_weight_path = str(tmpdir.join("player", "model_best_weight.h5"))
+    os.makedirs(str(tmpdir.join("player")))
+
+    pusher = CountingTransport(make_transport())
+    manifest = ModelStore(pusher, CHUNK_SIZE).push(config_path, weight_path)
+    assert len(pusher.writes) == NUM_CHUNKS + 1 # the chunks and the config
+    puller = CountingTransport(make_transport())
+    assert ModelStore(puller, CHUNK_SIZE).pull(pulled_config_path, pulled_weight_path) == manifest
+    assert file_digest(pulled_weight_path) == fetch_digest(pulled_weight_path) == manifest['digest']
+    assert len(puller.reads) == NUM_CHUNKS + 1
+
+    weights[3 * CHUNK_SIZE + 10] ^= 0xff # one chunk changes
+    write_model(str(tmpdir.join("trainer")), bytes(weights))
+    pusher = CountingTransport(make_transport())
+    manifest = ModelStore(pusher, CHUNK_SIZE).push(config_path, weight_path)
+    assert manifest['generation'] == 2
+    assert len(pusher.writes) == 1
+    puller = CountingTransport(make_transport())
+    assert ModelStore(puller, CHUNK_SIZE).pull(pulled_config_path, pulled_weight_path) == manifest
+    assert len(puller.reads) == 1
+    assert file_digest(pulled_weight_path) == fetch_digest(pulled_weight_path) == manifest['digest']
+    with open(pulled_weight_path, "rb") as f:
+        assert f.read() == bytes(weights)
+
+    puller = CountingTransport(make_transport())
+    ModelStore(puller, CHUNK_SIZE).pull(pulled_config_path, pulled_weight_path)
+    assert puller.reads == [] # up to date
+
+
+def test_local_store(tmpdir):
+    push_then_pull_a_change(tmpdir, lambda: LocalTransport(str(tmpdir.join("store"))))
+
+
+@pytest.mark.parametrize('key', [None, 'secret'])
+def test_socket_store(tmpdir, key):
+    config = Config()
+    config.resource.model_store_dir = str(tmpdir.join("store"))
+    config.resource.model_store_listen = "localhost:0"
+    config.resource.model_store_key = key
+    server = StoreServer(config)
+    listener = server.listen()
+    Thread(target=server.serve, args=(listener,), daemon=True).start()
+    push_then_pull_a_change(tmpdir, lambda: SocketTransport(listener.address, key))
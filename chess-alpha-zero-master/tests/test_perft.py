@@ -0,0 +1,14 @@
+import pytest
+
+from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.cchess.perft import REFERENCE_POSITIONS, perft
+
+MAX_DEPTH = 3
+
+
+@pytest.mark.parametrize('name, fen, counts', REFERENCE_POSITIONS, ids=[x[0] for x in REFERENCE_POSITIONS])
+def test_reference_counts(name, fen, counts):
+    board = Chessboard(fen)
+    for depth, expected in enumerate(counts[:MAX_DEPTH], 1):
+        assert perft(board, depth) == expected, "%s at depth %d" % (name, depth)
+    assert board.fen() == fen # every move was taken back
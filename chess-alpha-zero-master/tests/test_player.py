@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from chess_zero.agent.player_chess import ChessPlayer
+from chess_zero.config import Config
+from chess_zero.env.chess_env import ChessEnv
+from chess_zero.worker.benchmark import UniformPipe
+
+
+@pytest.mark.parametrize('search_batch_size', [0, 4])
+@pytest.mark.parametrize('simulation_num_per_move', [0, 1, 2])
+def test_action_with_few_simulations(simulation_num_per_move, search_batch_size):
+    config = Config()
+    config.play.simulation_num_per_move = simulation_num_per_move
+    config.play.search_batch_size = search_batch_size
+    config.play.search_threads = 2
+    player = ChessPlayer(config, pipes=[UniformPipe(config.n_labels) for _ in range(2)])
+    env = ChessEnv().reset()
+    for _ in range(4): # white and black
+        move = player.action(env)
+        assert move in env.board.legal_moves
+        labels, policy = player.moves[-1][1]
+        assert len(labels) > 0 and np.isclose(np.sum(policy), 1)
+        env.step(move)
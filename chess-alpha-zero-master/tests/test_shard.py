@@ -0,0 +1,69 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+from chess_zero.cchess.chessboard import Chessboard
+from chess_zero.cchess.common import init_fen
+from chess_zero.config import Config
+from chess_zero.env.chess_env import fens_to_planes
+from chess_zero.lib.data_helper import batch_generator, read_game_data_from_file, write_game_data_to_file
+from chess_zero.lib.shard import GameRecord, game_arrays, games_from_positions
+
+
+def random_json_games(num_games, num_plies, seed=0):
+    """:return: positions of consecutive random games in the json play data format, [fen, policy, value]"""
+    rnd = random.Random(seed)
+    data = []
+    for _ in range(num_games):
+        board = Chessboard(init_fen)
+        result = rnd.choice([1, 0, -1]) # for red
+        for _ in range(num_plies):
+            moves = board.legal_moves
+            if not moves:
+                break
+            policy = [0.0] * Config.n_labels
+            visited = rnd.sample(moves, min(len(moves), 5))
+            for move in visited:
+                policy[int(Config.move_lookup[move])] = rnd.random()
+            total = sum(policy)
+            policy = [x / total for x in policy]
+            fen = board.fen()
+            data.append([fen, policy, result if fen.split(' ')[1] != 'b' else -result])
+            board.push(rnd.choice(visited))
+    return json.loads(json.dumps(data)) # as read back from a json file
+
+
+def test_round_trip(tmpdir):
+    data = random_json_games(3, 40)
+    path = str(tmpdir.join(Config().resource.play_data_filename_tmpl % "test"))
+    write_game_data_to_file(path, games_from_positions(data))
+    games = read_game_data_from_file(path)
+    assert len(games) == 3
+
+    codes, values, indptr, labels, probs = game_arrays(games)
+    num = len(data)
+    assert len(codes) == num
+    np.random.seed(1)
+    planes, (policy_ary, value_ary) = next(batch_generator(codes, (indptr, labels, probs), values, num, num))
+    np.random.seed(1)
+    order = np.random.permutation(num) # the rows of the batch
+
+    fens, policies, json_values = zip(*[data[i] for i in order])
+    expected_planes, black = fens_to_planes(fens)
+    expected_policy = np.asarray(policies, dtype=np.float32)
+    expected_policy[black] = Config.flip_policy(expected_policy[black])
+    assert np.array_equal(planes, expected_planes)
+    assert np.array_equal(policy_ary, expected_policy)
+    assert np.array_equal(value_ary, np.float32(json_values))
+
+
+def test_rejects_moves_without_label():
+    game = GameRecord(init_fen, 0)
+    with pytest.raises(ValueError):
+        game.add([1, 2], [0.5, 0.5], move=-1)
+    with pytest.raises(ValueError):
+        game.add(np.array([3, 65535], dtype=np.uint16), [0.5, 0.5], move=3)
+    game.add([1, 2], [0.5, 0.5], move=1)
+    assert len(game) == 1